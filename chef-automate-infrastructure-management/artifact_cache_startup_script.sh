@@ -0,0 +1,39 @@
+#!/bin/bash
+
+# Serves the deployment's pinned artifacts to chef-network, keyed by SHA256:
+#   http://<cache>/sha256/<sha256>
+# Clients fall back to the upstream URL on a miss, so a cold cache is safe.
+
+set -e
+
+CACHE_DIR="/var/www/html/sha256"
+ARTIFACTS=(
+  # chef-server-core 12.16.14
+  "4ab1655336588e0b7b67bc779bff648273d53fddb393831fcdc7d359339460af https://packages.chef.io/files/stable/chef-server/12.16.14/ubuntu/16.04/chef-server-core_12.16.14-1_amd64.deb"
+  # chefdk 3.1.0
+  "6c897581b151204b5ee28a905384a12e79fbe66445922cac5645d45fc3c23cd5 https://packages.chef.io/files/stable/chefdk/3.1.0/debian/9/chefdk_3.1.0-1_amd64.deb"
+)
+
+function cache_artifact() {
+  # Download url ($2) and publish it under its sha256 ($1) once verified
+  _dest="$CACHE_DIR/$1"
+  [[ -f $_dest ]] && return 0
+  if wget -q -O "$_dest.part" "$2" && \
+    [[ $(sha256sum "$_dest.part" | awk '{print $1}') == "$1" ]]; then
+    mv "$_dest.part" "$_dest"
+  else
+    echo "artifact-cache: failed to cache $2"
+    rm -f "$_dest.part"
+    return 1
+  fi
+}
+
+apt-get update && apt-get install -y nginx-light
+mkdir -p $CACHE_DIR
+
+for artifact in "${ARTIFACTS[@]}"; do
+  cache_artifact $artifact &
+done
+wait
+
+echo "artifact-cache: ready"
@@ -0,0 +1,58 @@
+"""Creates the chef-network artifact cache instance"""
+
+def GenerateConfig(context):
+    
+    project = context.env["project"]
+    name = context.env["name"]
+    zone = context.properties["zone"]
+    network = "chef-network"
+    networkIP = context.properties["networkIP"]
+
+    resources = []
+    outputs = []
+
+    resources.append({
+        'name': name,
+        'type': 'compute.v1.instance',
+        'properties': {
+            'zone': zone,
+            'machineType': 'https://www.googleapis.com/compute/v1/projects/{}'
+                '/zones/{}/machineTypes/{}'.format(project, zone, 'g1-small'),
+            'disks': [{
+                'deviceName': 'boot',
+                'type': 'PERSISTENT',
+                'boot': True,
+                'autoDelete': True,
+                'initializeParams': {
+                    'sourceImage': 'projects/debian-cloud/global/images/family/debian-9',
+                    'diskType': 'https://www.googleapis.com/compute/v1'
+                    '/projects/{}/zones/{}/diskTypes/pd-standard'.format(project, zone),
+                    'diskSizeGb': 20
+                }
+            }],
+            'networkInterfaces': [{
+                              'network': '$(ref.{}.selfLink)'.format(network),
+                              'subnetwork': '$(ref.{}-subnet.selfLink)'.format(network),
+                              'accessConfigs': [{
+                                  'name': 'External NAT',
+                                  'type': 'ONE_TO_ONE_NAT'
+                               }],
+                               'networkIP': networkIP
+          }],
+            # Only reachable from inside the 10.0.0.0/25 subnet.
+            'tags': {'items': ["ssh-server", "{}-allow-internal-ports".format(network)]},
+            'metadata': {
+                'items': [{
+                          'key': 'startup-script',
+                          'value': context.imports["artifact_cache_startup_script.sh"]
+                          }]
+            }
+        }
+    })
+
+    outputs.append({
+        'name': 'url',
+        'value': 'http://{}'.format(networkIP)
+        })
+
+    return {'resources': resources, 'outputs': outputs}
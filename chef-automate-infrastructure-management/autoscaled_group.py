@@ -1,9 +1,143 @@
+# Autoscaler defaults. app.jinja and frontend_service_template.py pass on only
+# the properties a deployment sets, so these are the only copies.
+# minNumReplicas is required: app.jinja also sizes the node waiter with it.
+AUTOSCALING_DEFAULTS = {
+    "maxNumReplicas": 10,
+    "cpuUtilizationTarget": 0.6,
+    "loadBalancingUtilizationTarget": 0.8,
+    "coolDownPeriodSec": 90,
+    "scaleInMaxReplicas": 2,
+    "scaleInTimeWindowSec": 300,
+}
+
+
+class PropertyError(Exception):
+  """An exception raised when property values are invalid."""
+  pass
+
+
+def _Property(context, key):
+  """Returns an autoscaling property, or its default when unset or empty."""
+  value = context.properties.get(key)
+  if value is None or value == "":
+    return AUTOSCALING_DEFAULTS.get(key)
+  return value
+
+
+def _Int(context, key):
+  """Returns an integer autoscaling property or its default."""
+  value = _Property(context, key)
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    raise PropertyError('Invalid {} value: {}'.format(key, value))
+
+
+def _Utilization(context, key):
+  """Returns a utilization target in (0, 1], or None when set to 0."""
+  value = _Property(context, key)
+  try:
+    value = float(value)
+  except (TypeError, ValueError):
+    raise PropertyError('Invalid {} value: {}'.format(key, value))
+  if value == 0:
+    return None
+  if not 0 < value <= 1:
+    raise PropertyError('{} must be in (0, 1], got {}'.format(key, value))
+  return value
+
+
+def _AutoscalingPolicy(context):
+  """Builds the autoscaling policy from the scaling properties."""
+  minNumReplicas = _Int(context, "minNumReplicas")
+  maxNumReplicas = _Int(context, "maxNumReplicas")
+  if not 0 < minNumReplicas <= maxNumReplicas:
+    raise PropertyError('Invalid replica range: {} to {}'.format(
+        minNumReplicas, maxNumReplicas))
+  targetSize = _Int(context, "targetSize")
+  if not minNumReplicas <= targetSize <= maxNumReplicas:
+    raise PropertyError('targetSize {} is outside the replica range {} to '
+                        '{}'.format(targetSize, minNumReplicas,
+                                    maxNumReplicas))
+
+  policy = {
+      'minNumReplicas': minNumReplicas,
+      'maxNumReplicas': maxNumReplicas,
+      'coolDownPeriodSec': _Int(context, "coolDownPeriodSec"),
+  }
+
+  cpuTarget = _Utilization(context, "cpuUtilizationTarget")
+  if cpuTarget is not None:
+    policy['cpuUtilization'] = {'utilizationTarget': cpuTarget}
+
+  # Scales on the share of the backend service's balancing capacity in use.
+  lbTarget = _Utilization(context, "loadBalancingUtilizationTarget")
+  if lbTarget is not None:
+    policy['loadBalancingUtilization'] = {'utilizationTarget': lbTarget}
+
+  # 0 or an empty value turns scale-in control off, rather than falling back
+  # to the default.
+  scaleInMaxReplicas = context.properties.get(
+      "scaleInMaxReplicas", AUTOSCALING_DEFAULTS["scaleInMaxReplicas"])
+  try:
+    scaleInMaxReplicas = int(scaleInMaxReplicas or 0)
+  except (TypeError, ValueError):
+    raise PropertyError(
+        'Invalid scaleInMaxReplicas value: {}'.format(scaleInMaxReplicas))
+  if scaleInMaxReplicas:
+    policy['scaleInControl'] = {
+        'maxScaledInReplicas': {'fixed': scaleInMaxReplicas},
+        'timeWindowSec': _Int(context, "scaleInTimeWindowSec"),
+    }
+
+  return policy
+
+
+def _Region(zones):
+  """Returns the region shared by a list of zones."""
+  regions = set(zone.rsplit('-', 1)[0] for zone in zones)
+  if len(regions) != 1:
+    raise PropertyError('zones must share one region, got {}'.format(
+        ', '.join(zones)))
+  return regions.pop()
+
+
 def GenerateConfig(context):
   
+  project = context.env["project"]
   zone = context.properties["zone"]
+  zones = context.properties.get("zones") or []
   targetSize = context.properties["targetSize"]
   instanceTemplate = context.properties["instanceTemplate"]
 
+  if zones:
+    # A regional group spreads its instances over every listed zone.
+    region = _Region(zones)
+    resources = [{
+        'name': context.env["name"] + '-igm',
+        'type': 'compute.v1.regionInstanceGroupManager',
+        'properties': {
+          'region': region,
+          'targetSize': targetSize,
+          'baseInstanceName': context.env["name"] + '-instance',
+          'instanceTemplate': instanceTemplate,
+          'distributionPolicy': {
+            'zones': [{
+                'zone': 'https://www.googleapis.com/compute/v1/projects/{}'
+                    '/zones/{}'.format(project, z)} for z in zones]
+          }
+        }
+    }, {
+        'name': context.env["name"] + '-as',
+        'type': 'compute.v1.regionAutoscaler',
+        'properties': {
+          'region': region,
+          'target': '$(ref.{}-igm.selfLink)'.format(context.env["name"]),
+          'autoscalingPolicy': _AutoscalingPolicy(context)
+        }
+    }]
+    return {'resources': resources}
+
   resources = [{
       'name': context.env["name"] + '-igm',
       'type': 'compute.v1.instanceGroupManager',
@@ -19,10 +153,7 @@ def GenerateConfig(context):
       'properties': {
         'zone': zone,
         'target': '$(ref.{}-igm.selfLink)'.format(context.env["name"]),
-        'autoscalingPolicy':{
-            'minNumReplicas': targetSize,
-            'maxNumReplicas': targetSize,
-            }
+        'autoscalingPolicy': _AutoscalingPolicy(context)
       }
   }]
   
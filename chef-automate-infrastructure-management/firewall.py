@@ -84,9 +84,7 @@ def GenerateConfig(context):
               'ports': ["1-65535"]
               },
               {'IPProtocol': 'ICMP'}]
-          },
-      'metadata':{
-          'dependsOn': [name]}
+          }
       },
       {
       'name': name + '-tcp-9090',
@@ -1,10 +1,69 @@
+BALANCING_MODES = ["UTILIZATION", "RATE"]
+SESSION_AFFINITIES = ["NONE", "CLIENT_IP", "GENERATED_COOKIE"]
+
+
+class PropertyError(Exception):
+  """An exception raised when property values are invalid."""
+  pass
+
+
+def _Backend(context, name):
+  """Returns the backend entry, sized for g1-small Apache nodes by default."""
+  balancingMode = context.properties.get("balancingMode", "UTILIZATION")
+  if balancingMode not in BALANCING_MODES:
+    raise PropertyError('Invalid balancingMode value: {}'.format(balancingMode))
+
+  backend = {
+      'name': name + '-primary',
+      'group': '$(ref.{}-pri-igm.instanceGroup)'.format(name),
+      'balancingMode': balancingMode,
+      'capacityScaler': float(context.properties.get("capacityScaler", 1.0)),
+  }
+  if balancingMode == "RATE":
+    backend['maxRatePerInstance'] = float(
+        context.properties.get("maxRatePerInstance", 100))
+  else:
+    backend['maxUtilization'] = float(
+        context.properties.get("maxUtilization", 0.8))
+  return backend
+
+
+def _SessionAffinity(context):
+  """Returns the sessionAffinity property or NONE if unspecified."""
+  sessionAffinity = context.properties.get("sessionAffinity", "NONE")
+  if sessionAffinity not in SESSION_AFFINITIES:
+    raise PropertyError(
+        'Invalid sessionAffinity value: {}'.format(sessionAffinity))
+  return sessionAffinity
+
+
+def _HealthCheck(context):
+  """Returns the health check properties for the web nodes."""
+  checkIntervalSec = int(context.properties.get("checkIntervalSec", 3))
+  timeoutSec = int(context.properties.get("healthCheckTimeoutSec", 3))
+  if timeoutSec > checkIntervalSec:
+    raise PropertyError('healthCheckTimeoutSec ({}) must not exceed '
+                        'checkIntervalSec ({})'.format(timeoutSec,
+                                                       checkIntervalSec))
+  return {
+      'port': context.properties["port"],
+      # chef_apache2 serves a static /healthz, so probes skip the page render.
+      'requestPath': context.properties.get("requestPath", "/healthz"),
+      'checkIntervalSec': checkIntervalSec,
+      'timeoutSec': timeoutSec,
+      'healthyThreshold': int(context.properties.get("healthyThreshold", 2)),
+      'unhealthyThreshold': int(
+          context.properties.get("unhealthyThreshold", 2)),
+  }
+
+
 def GenerateConfig(context):
   
   name = context.env["name"]
   zone = context.properties["zone"]
   port = context.properties["port"]
   service = context.properties["service"]
-  targetSize = 5
+  targetSize = context.properties.get("targetSize", 5)
   userName = context.properties["userName"]
   password = context.properties["userPassword"]
   sshpubkey = context.properties["sshPubKey"]
@@ -12,6 +71,12 @@ def GenerateConfig(context):
   statusVariablePath = context.properties["statusVariablePath"]
   statusUptimeDeadline = context.properties["statusUptimeDeadline"]
 
+  # The autoscaling properties pass through unchanged; autoscaled_group.py
+  # validates them and fills in its defaults.
+  group = dict(context.properties.get("autoscaling") or {})
+  if context.properties.get("zones"):
+    group['zones'] = context.properties["zones"]
+
   resources = [{
       'name': name,
       'type': 'node_instance_template.py',
@@ -23,35 +88,46 @@ def GenerateConfig(context):
         'statusConfigUrl': statusConfigUrl,
         'statusVariablePath': statusVariablePath,
         'statusUptimeDeadline': statusUptimeDeadline,
+        'statusStallWindow': context.properties.get("statusStallWindow", 300),
+        'sourceImage': context.properties.get("sourceImage"),
+        'imageFamily': context.properties.get("imageFamily"),
+        'profile': context.properties.get("profile"),
+        'machineType': context.properties.get("machineType"),
+        'diskType': context.properties.get("diskType"),
+        'diskSizeGb': context.properties.get("diskSizeGb"),
+        'artifactCacheUrl': context.properties.get("artifactCacheUrl", ""),
+        'chefClientInterval': context.properties.get("chefClientInterval"),
+        'chefClientSplay': context.properties.get("chefClientSplay"),
       }
   }, {
       'name': name + "-pri",
       'type': 'autoscaled_group.py',
-      'properties': {
+      'properties': dict(group, **{
         'zone': zone,
         'port': port,
         'service': service,
         'baseInstanceName': name + "-instance",
         'instanceTemplate': '$(ref.{}-it.selfLink)'.format(name),
         'targetSize': targetSize
-      }
+      })
   }, {
       'name': name + "-hc",
       'type': 'compute.v1.httpHealthCheck',
-      'properties': {
-      	'port': port,
-      }
+      'properties': _HealthCheck(context)
   }, {
       'name': name + "-bes",
       'type': 'compute.v1.backendService',
       'properties': {
       	'port': port,
         'portName': service,
-        'backends':[{
-            'name': name + '-primary',
-            'group': '$(ref.{}-pri-igm.instanceGroup)'.format(name),
-            }],
-        'healthChecks': ['$(ref.{}-hc.selfLink)'.format(name)]
+        'backends':[_Backend(context, name)],
+        'healthChecks': ['$(ref.{}-hc.selfLink)'.format(name)],
+        'timeoutSec': int(context.properties.get("timeoutSec", 30)),
+        'connectionDraining': {
+            'drainingTimeoutSec': int(
+                context.properties.get("drainingTimeoutSec", 30)),
+        },
+        'sessionAffinity': _SessionAffinity(context)
       }
   }]
   
@@ -1,3 +1,35 @@
+import profiles
+
+
+class PropertyError(Exception):
+  """An exception raised when property values are invalid."""
+  pass
+
+
+def _Seconds(context, key, default):
+  """Returns a property as a non-negative number of seconds."""
+  value = context.properties.get(key)
+  if value in (None, ""):
+    value = default
+  try:
+    value = int(value)
+  except (TypeError, ValueError):
+    raise PropertyError('Invalid {} value: {}'.format(key, value))
+  if value < 0:
+    raise PropertyError('{} must not be negative, got {}'.format(key, value))
+  return value
+
+
+def _SourceImage(context):
+  """Returns the boot image: sourceImage, imageFamily or stock debian-9."""
+  if context.properties.get("sourceImage"):
+    return context.properties["sourceImage"]
+  if context.properties.get("imageFamily"):
+    return 'projects/{}/global/images/family/{}'.format(
+        context.env["project"], context.properties["imageFamily"])
+  return 'projects/debian-cloud/global/images/family/debian-9'
+
+
 def GenerateConfig(context):
   
   deployment = context.env["deployment"]
@@ -12,6 +44,8 @@ def GenerateConfig(context):
   statusVariablePath = context.properties["statusVariablePath"]
   statusUptimeDeadline = context.properties["statusUptimeDeadline"]
 
+  sizing = profiles.Sizing(context, 'node')
+
   resources = []
   outputs = []
 
@@ -21,7 +55,7 @@ def GenerateConfig(context):
       'properties': {
         'properties':{
           'zone': zone,
-          'machineType': "g1-small",
+          'machineType': sizing['machineType'],
           'canIpForward': True,
           'disks': [{
               'deviceName': 'boot',
@@ -29,9 +63,9 @@ def GenerateConfig(context):
               'boot': True,
               'autoDelete': True,
               'initializeParams': {
-                  'sourceImage': 'projects/debian-cloud/global/images/family/debian-9',
-                  'diskType': 'pd-standard',
-                  'diskSizeGb': 10
+                  'sourceImage': _SourceImage(context),
+                  'diskType': sizing['diskType'],
+                  'diskSizeGb': sizing['diskSizeGb']
               }
           }],
           'networkInterfaces': [{
@@ -60,10 +94,30 @@ def GenerateConfig(context):
                           'key': 'status-variable-path',
                           'value': statusVariablePath
                         },
+                        {
+                          'key': 'status-role',
+                          'value': 'node'
+                        },
                         {
                           'key': 'status-uptime-deadline',
                           'value': statusUptimeDeadline
                         },
+                        {
+                          'key': 'status-stall-window',
+                          'value': context.properties.get("statusStallWindow", 300)
+                        },
+                        {
+                          'key': 'chef-client-interval',
+                          'value': _Seconds(context, "chefClientInterval", 0)
+                        },
+                        {
+                          'key': 'chef-client-splay',
+                          'value': _Seconds(context, "chefClientSplay", 300)
+                        },
+                        {
+                          'key': 'artifact-cache-url',
+                          'value': context.properties.get("artifactCacheUrl", "")
+                        },
                         {
                           'key': 'startup-script',
                           'value': """
@@ -77,10 +131,8 @@ def GenerateConfig(context):
                                 chmod -R go-rwx ~{username}/.ssh
                                 echo "Done adding new user {username}"
                                 {context}
-                                sleep 60
-                                result=$?
-                                if [ $result -eq 0 ]; then
-                                  curl --connect-timeout 120 --max-time 120 --retry 5 --retry-delay 0 --retry-max-time 60 -sfH "Metadata-Flavor: Google" "http://metadata.google.internal/computeMetadata/v1/project/attributes/ssh-keys" | python3 -c "import sys; [print(k) for k in [key.strip().split(':')[-1] for key in sys.stdin.readlines()]]" >> ~{username}/.ssh/authorized_keys
+                                if init_status; then
+                                  wait_for_ssh_keys 60 | python3 -c "import sys; [print(k) for k in [key.strip().split(':')[-1] for key in sys.stdin.readlines()]]" >> ~{username}/.ssh/authorized_keys
                                 fi
                                 """.format(
                                     username = username,
@@ -95,31 +147,6 @@ def GenerateConfig(context):
         }
     }) 
 
-  resources.append({
-      'name': "{}-waiter".format(name),
-      'type': 'runtimeconfig.v1beta1.waiter',
-      'metadata': {
-          'dependsOn': [name],
-      },
-      'properties': {
-          'parent': '$(ref.{}-config.name)'.format(context.env["deployment"]),
-          'waiter': "{}-waiter".format(name),
-          'timeout': '{}s'.format(statusUptimeDeadline),
-          'success': {
-              'cardinality': {
-                  'number': 5,
-                  'path': '{}/success'.format(statusVariablePath),
-              },
-          },
-          'failure': {
-              'cardinality': {
-                  'number': 1,
-                  'path': '{}/failure'.format(statusVariablePath),
-              },
-          },
-      },
-    }) 
-
   outputs.append({
       'name': 'instanceTemplateSelfLink',
       'value': '$(ref.{}-it.selfLink)'.format(context.env["name"])
@@ -5,7 +5,24 @@
 set -e
 
 DEFAULT_UPTIME_DEADLINE="300" # 5 minutes
+METADATA_CACHE="/run/chef-deployment/metadata"
+TIMINGS_FILE="/run/chef-deployment/timings"
+PROGRESS_FILE="/run/chef-deployment/progress"
+STATUS_POSTED="/run/chef-deployment/status-posted"
+INIT_STATUS_FILE="/run/chef-deployment/init-status"
+DEFAULT_STALL_WINDOW="300" # 5 minutes
+HEARTBEAT_SEC="15"
+BAKED_MARKER="/etc/chef-deployment-baked"
+STEP_DIR="/tmp/boot-steps"
+STEP_NAMES=()
+declare -A STEP_DEPS STEP_TIMEOUT STEP_RETRIES STEP_COMMAND
+CHECK_NAMES=()
+declare -A CHECK_COMMAND
+CHECK_MIN_DELAY_MS="250"
+CHECK_MAX_DELAY_MS="8000"
 CHEF_SHA256="6c897581b151204b5ee28a905384a12e79fbe66445922cac5645d45fc3c23cd5"
+CHEF_DEB="/tmp/chef-install.deb"
+CHEF_URL="https://packages.chef.io/files/stable/chefdk/3.1.0/debian/9/chefdk_3.1.0-1_amd64.deb"
 SHARE="/share"
 CHEF_DIR="$SHARE/.chef"
 COOKBOOKS="$SHARE/cookbooks"
@@ -32,15 +49,46 @@ CLOUD_TEMPLATE="$CLOUD_PATH/$TEMPLATE_NAME"
 MANAGE_NODES_NAME="manage_nodes.sh"
 MANAGE_NODES_FILE="$SHARE/$MANAGE_NODES_NAME"
 CLOUD_MANAGE_NODES_FILE="$CLOUD_PATH/$MANAGE_NODES_NAME"
+MANAGE_FLEET_FILE="$SHARE/manage_fleet.py"
 
-function metadata_value() {
+function fetch_metadata_value() {
   curl --retry 5 -sfH "Metadata-Flavor: Google" \
     "http://metadata.google.internal/computeMetadata/v1/$1"
 }
 
+function metadata_value() {
+  # Metadata is fixed for the boot: each key is fetched once and then read
+  # from $METADATA_CACHE, which every subshell and boot step shares.
+  _cached="$METADATA_CACHE/${1//\//_}"
+  if [[ ! -f "$_cached" ]]; then
+    # $BASHPID, not $$: concurrent boot steps are subshells of one script
+    _tmp="$_cached.$BASHPID"
+    mkdir -p "$METADATA_CACHE" && \
+    fetch_metadata_value "$1" > "$_tmp" && \
+    mv "$_tmp" "$_cached" || { rm -f "$_tmp"; return 1; }
+  fi
+  cat "$_cached"
+}
+
 function access_token() {
-  metadata_value "instance/service-accounts/default/token" \
-    | python -c "import sys, json; print json.load(sys.stdin)['access_token']"
+  # The OAuth token is cached as "EXPIRY TOKEN" until a minute before expiry.
+  _token_file="$METADATA_CACHE/access_token"
+  if [[ ! -f "$_token_file" || \
+    $(date +%s) -ge $(cut -d' ' -f1 "$_token_file") ]]; then
+    _json="$(fetch_metadata_value "instance/service-accounts/default/token")" \
+      || return 1
+    _re='"access_token": *"([^"]+)"'
+    [[ $_json =~ $_re ]] || return 1
+    _token="${BASH_REMATCH[1]}"
+    _re='"expires_in": *([0-9]+)'
+    [[ $_json =~ $_re ]] || return 1
+    _tmp="$_token_file.$BASHPID"
+    mkdir -p "$METADATA_CACHE" && \
+    ( umask 077 && \
+      echo "$(($(date +%s) + BASH_REMATCH[1] - 60)) $_token" > "$_tmp" ) && \
+    mv "$_tmp" "$_token_file"
+  fi
+  cut -d' ' -f2 "$_token_file"
 }
 
 function retrieve_script() {
@@ -49,6 +97,42 @@ function retrieve_script() {
     -o "${2}"
 }
 
+function artifact_cache_url() {
+  metadata_value "instance/attributes/artifact-cache-url" || true
+}
+
+function verify_sha256() {
+  [[ $(sha256sum "$1" | awk '{print $1}') == "$2" ]]
+}
+
+function fetch_artifact() {
+  # Fetch url ($1) pinned to sha256 ($2) into $3: the chef-network artifact
+  # cache first, the upstream url when the cache is unset, cold or wrong.
+  _cache="$(artifact_cache_url)"
+  if [[ ! -z "$_cache" ]] && \
+    heartbeat "$3" curl -sf --connect-timeout 2 "$_cache/sha256/$2" -o "$3" && \
+    verify_sha256 "$3" "$2"; then
+    return 0
+  fi
+  heartbeat "$3" wget -O "$3" "$1" && verify_sha256 "$3" "$2"
+}
+
+function heartbeat() {
+  # heartbeat PATH COMMAND...: run COMMAND and log the size of PATH whenever it
+  # grew, so a long download or build counts as boot step output while it moves
+  ( _size=""
+    while sleep $HEARTBEAT_SEC; do
+      _grown="$(du -sb "$1" 2> /dev/null | cut -f1)"
+      [[ -z "$_grown" || "$_grown" == "$_size" ]] || echo "$1: $_grown bytes"
+      _size="$_grown"
+    done ) &
+  _heartbeat=$!
+  _heartbeat_rc=0
+  "${@:2}" || _heartbeat_rc=$?
+  kill $_heartbeat 2> /dev/null || true
+  return $_heartbeat_rc
+}
+
 function uptime_seconds() {
   seconds="$(cat /proc/uptime | cut -d' ' -f1)"
   echo "${seconds%%.*}" # delete floating point.
@@ -75,6 +159,10 @@ function variable_path() {
   metadata_value "instance/attributes/status-variable-path"
 }
 
+function status_role() {
+  metadata_value "instance/attributes/status-role"
+}
+
 function server_name() {
   metadata_value "instance/attributes/server-name"
 }
@@ -125,75 +213,209 @@ function config_name() {
   echo "${_config_name}"
 }
 
+function uptime_ms() {
+  # Milliseconds since boot: monotonic, unlike the wall clock
+  read _uptime _idle < /proc/uptime
+  echo $((10#${_uptime%.*} * 1000 + 10#${_uptime#*.} * 10))
+}
+
+function record_timing() {
+  # record_timing PHASE START_MS END_MS
+  mkdir -p "$(dirname $TIMINGS_FILE)" && echo "$1 $2 $3" >> $TIMINGS_FILE && \
+  progress "$1 done"
+}
+
+function timed() {
+  # timed PHASE COMMAND...: run COMMAND and record its span as PHASE
+  _timed_start=$(uptime_ms)
+  progress "$1 started"
+  _timed_rc=0
+  "${@:2}" || _timed_rc=$?
+  record_timing "$1" $_timed_start $(uptime_ms)
+  return $_timed_rc
+}
+
+function timings_json() {
+  # Every recorded phase, as published to <path>-timings/<instance id>
+  printf '{"host":"%s","phases":[' "$(hostname)"
+  _separator=""
+  while read _phase _start _end; do
+    printf '%s{"phase":"%s","startMs":%s,"endMs":%s,"durationMs":%s}' \
+      "$_separator" "$_phase" "$_start" "$_end" "$((_end - _start))"
+    _separator=","
+  done < <(cat $TIMINGS_FILE 2> /dev/null)
+  printf ']}'
+}
+
 function variable_body() {
-  encoded_value=$(echo "$2" | base64)
+  encoded_value=$(echo "$2" | base64 -w 0)
   printf '{"name":"%s", "value":"%s"}\n' "${1}" "$encoded_value"
 }
 
 function post_result() {
-  var_subpath=$1
-  var_value=$2
-  var_path="$(config_name)/variables/$var_subpath/$(instance_id)"
+  # post_result SUBPATH VALUE [SUBPATH VALUE]... writes every variable in one
+  # curl call, so they share a single keep-alive connection.
+  _url="$(config_url)/variables"
+  _token="$(access_token)"
+  _args=()
+  while [[ $# -gt 1 ]]; do
+    [[ ${#_args[@]} -eq 0 ]] || _args+=(--next)
+    var_path="$(config_name)/variables/$1/$(instance_id)"
+    _args+=(--retry 5 -sH "Authorization: Bearer $_token" \
+      -H "Content-Type: application:json" \
+      -X POST -d "$(variable_body "$var_path" "$2")" "$_url")
+    shift 2
+  done
+  curl "${_args[@]}"
+}
+
+function wait_for_ssh_keys() {
+  # Print the project ssh-keys once the workstation has published the
+  # deployment user's keys, following metadata changes for at most $1 seconds.
+  _user="$(user_name | sed -e 's/-/_/g')"
+  _url="http://metadata.google.internal/computeMetadata/v1/project/attributes/ssh-keys"
+  _deadline=$((SECONDS + $1))
+  _etag=0
+  _keys=""
+  while [[ $SECONDS -lt $_deadline ]]; do
+    _headers="$(mktemp)"
+    _keys="$(curl -sf -D "$_headers" -H "Metadata-Flavor: Google" \
+      "$_url?wait_for_change=true&last_etag=$_etag&timeout_sec=$((_deadline - SECONDS))")" \
+      || true
+    _etag="$(awk 'tolower($1) == "etag:" {print $2}' "$_headers" | tr -d '\r')"
+    rm -f "$_headers"
+    if grep -q "^$_user:" <<< "$_keys"; then
+      echo "$_keys"
+      return 0
+    fi
+    # Without an etag there is no change to wait on, so poll instead.
+    [[ ! -z "$_etag" ]] || { _etag=0; sleep 1; }
+  done
+  echo "$_keys"
+  return 1
+}
+
+function bake_image() {
+  metadata_value "instance/attributes/bake-image" > /dev/null
+}
 
-  curl --retry 5 -sH "Authorization: Bearer $(access_token)" \
-    -H "Content-Type: application:json" \
-    -X POST -d "$(variable_body "$var_path" "$var_value")" \
-    "$(config_url)/variables"
+function is_baked() {
+  [[ -f $BAKED_MARKER ]]
 }
 
 function post_success() {
-  if [[ ! -z "$2" ]]; then
-    post_result "$2/success" "${1:-Success}"
-  else
-    post_result "$(variable_path)/success" "${1:-Success}"
-  fi
+  # Reports land in <path>/success/<role>/<instance id>, where the
+  # deployment's waiter for the role counts them.
+  mkdir -p "$(dirname $STATUS_POSTED)" && touch $STATUS_POSTED
+  post_result "$(variable_path)/success/$(status_role)" "${1:-Success}" \
+    "$(variable_path)-timings" "$(timings_json)"
 }
 
 function post_failure() {
-  if [[ ! -z "$2" ]]; then
-    post_result "$2/failure" "${1:-Failure}"
-  else
-    post_result "$(variable_path)/failure" "${1:-Failure}"
-  fi
+  mkdir -p "$(dirname $STATUS_POSTED)" && touch $STATUS_POSTED
+  post_result "$(variable_path)/failure/$(status_role)" "${1:-Failure}" \
+    "$(variable_path)-timings" "$(timings_json)"
 }
 
-function check_success() {
-  # custom success checks go here
+function progress() {
+  # Mark progress for watch_progress: progress DESCRIPTION
+  mkdir -p "$(dirname $PROGRESS_FILE)" && \
+  echo "$(uptime_ms) $*" >> $PROGRESS_FILE
+}
+
+function stall_window() {
+  metadata_value "instance/attributes/status-stall-window" \
+    || echo $DEFAULT_STALL_WINDOW
+}
+
+function put_result() {
+  # Create or overwrite one variable: put_result SUBPATH VALUE
+  _name="$(config_name)/variables/$1/$(instance_id)"
+  _body="$(variable_body "$_name" "$2")"
+  _auth="Authorization: Bearer $(access_token)"
+  curl -sf -H "$_auth" -H "Content-Type: application/json" \
+    -X PUT -d "$_body" "https://runtimeconfig.googleapis.com/v1beta1/$_name" \
+    > /dev/null || \
+  curl -sf -H "$_auth" -H "Content-Type: application/json" \
+    -X POST -d "$_body" "$(config_url)/variables" > /dev/null
+}
+
+function stalled() {
+  # stalled WINDOW SINCE_MS: no progress mark since SINCE_MS and no boot step
+  # output for WINDOW seconds, even while a quiet step is still running
+  [[ $((($(uptime_ms) - $2) / 1000)) -ge $1 ]] && \
+  [[ -z "$(find $STEP_DIR -name '*.log' -newermt "$1 seconds ago" 2> /dev/null)" ]]
+}
+
+function watch_progress() {
+  # Publish each progress mark to <path>/progress/<instance id> and post a
+  # failure once the host stalls for the stall window, so the waiters fail
+  # fast instead of running into their timeout.
+  _window="$(stall_window)"
+  _last=""
+  while [[ ! -f $STATUS_POSTED ]]; do
+    _latest="$(tail -n 1 $PROGRESS_FILE 2> /dev/null)" || true
+    if [[ "$_latest" != "$_last" ]]; then
+      _last="$_latest"
+      put_result "$(variable_path)/progress" "${_latest#* }" || true
+    elif stalled $_window ${_latest%% *}; then
+      echo "software-status: stalled for ${_window}s after ${_latest#* }"
+      post_failure "stalled for ${_window}s after ${_latest#* }" || true
+      return 1
+    fi
+    sleep $HEARTBEAT_SEC
+  done
+}
+
+function chefdk_installed() {
   dpkg -l chefdk && \
-  [[ -f $KNIFE_FILE ]] && \
-  [[ -f $GET_CHEF_KEY_FILE ]] && \
-  [[ -f $MANAGE_NODES_FILE ]] && \
-  [[ -f $RECIPE_FILE ]] && \
-  [[ -f $TEMPLATE_FILE ]] && \
-  [[ -f $METADATA_FILE ]] && \
   [[ $(chef --version | grep 'Chef Development Kit Version:' | awk '{print $5}') == '3.1.0' ]]
 }
 
-function install_chef() {
-  CHEF_DEB="/tmp/chef-install.deb" && \
-  wget -O $CHEF_DEB https://packages.chef.io/files/stable/chefdk/3.1.0/debian/9/chefdk_3.1.0-1_amd64.deb && \
-  CHEF_SHA256_DOWNLOAD=$(sha256sum $CHEF_DEB | awk '{print $1}') && \
-  [[ $CHEF_SHA256_DOWNLOAD == "$CHEF_SHA256" ]] && \
-  dpkg -i $CHEF_DEB
+function custom_checks() {
+  # custom success checks go here
+  check chefdk chefdk_installed
+  check knife "[[ -f $KNIFE_FILE ]]"
+  check chef_key "[[ -f $GET_CHEF_KEY_FILE ]]"
+  check manage_nodes "[[ -f $MANAGE_NODES_FILE ]]"
+  check recipe "[[ -f $RECIPE_FILE ]]"
+  check template "[[ -f $TEMPLATE_FILE ]]"
+  check metadata "[[ -f $METADATA_FILE ]]"
+  check manage_fleet "[[ -x $MANAGE_FLEET_FILE ]]"
 }
 
-function custom_init() {
-  # custom init commands go here
+function add_healthz_resource() {
+  # Serve a static /healthz from chef_apache2 so LB health checks stay cheap
+  printf '\nfile "/var/www/html/healthz" do\n  content "ok\\n"\n  mode "0644"\nend\n' \
+    >> $RECIPE_FILE
+}
+
+function install_manage_fleet() {
+  # The parallel bootstrap/converge tool ships as workstation metadata
+  metadata_value "instance/attributes/manage-fleet" > $MANAGE_FLEET_FILE && \
+    chmod 755 $MANAGE_FLEET_FILE
+}
+
+function install_steps() {
+  # steps baked into the chef-workstation role image
+  step apt "" 600 2 "apt-get update && apt-get install -y git"
+  step fetch_chefdk "" 900 2 "fetch_artifact $CHEF_URL $CHEF_SHA256 $CHEF_DEB"
+  step install_chefdk "apt fetch_chefdk" 600 0 "dpkg -i $CHEF_DEB"
+}
+
+function install_software() {
+  # Run only the install steps, which bake-image turns into a role image
+  install_steps && run_steps
+}
+
+function configure_workstation() {
   _USER_NAME=$(user_name) && \
   _USER_PASSWORD=$(user_password) && \
   CORRECTED_USER_NAME=$(echo "$_USER_NAME" | sed -e 's/-/_/g') && \
   GET_ZONE=$(metadata_value "instance/zone" | python3 -c "import sys; print(sys.stdin.readlines()[0].split('/')[-1])") && \
   CHEF_SERVER_FQDN="$(server_name).$GET_ZONE.c.$(project_name).internal" && \
-  apt-get update && apt-get install -y git && install_chef && \
-  mkdir $SHARE $CHEF_DIR $COOKBOOKS $CHEF_APACHE2_DIR $RECIPES_DIR $TEMPLATES_DIR && \
-  retrieve_script $CLOUD_KNIFE_FILE $KNIFE_FILE && \
-  retrieve_script $CLOUD_CHEF_KEY_FILE $GET_CHEF_KEY_FILE && \
   sed -i '11a\GET_ZONE=$(metadata_value "instance/zone" | python3 -c "import sys; print(sys.stdin.readlines()[0].split('\'/\'')[-1])")\n' $GET_CHEF_KEY_FILE && \
   sed -i "s/\.c\./\.\$GET_ZONE\.c\./g" $GET_CHEF_KEY_FILE && \
-  retrieve_script $CLOUD_MANAGE_NODES_FILE $MANAGE_NODES_FILE && \
-  retrieve_script $CLOUD_RECIPE $RECIPE_FILE && \
-  retrieve_script $CLOUD_TEMPLATE $TEMPLATE_FILE && \
-  retrieve_script $CLOUD_METADATA $METADATA_FILE && \
   sed -i "s/CHEF_SERVER/$CHEF_SERVER_FQDN/g" $KNIFE_FILE && \
   sed -i "s/--identity-file/-P $_USER_PASSWORD --ssh-identity-file/g" $MANAGE_NODES_FILE && \
   create_new_ssh_key "$CORRECTED_USER_NAME" && \
@@ -204,8 +426,143 @@ function custom_init() {
   chmod 777 $TEMPLATE_FILE
 }
 
+function custom_init() {
+  # custom init commands go here
+  mkdir -p $SHARE $CHEF_DIR $COOKBOOKS $CHEF_APACHE2_DIR $RECIPES_DIR $TEMPLATES_DIR && \
+  { is_baked || install_steps; } && \
+  step knife "" 120 3 "retrieve_script $CLOUD_KNIFE_FILE $KNIFE_FILE" && \
+  step chef_key "" 120 3 "retrieve_script $CLOUD_CHEF_KEY_FILE $GET_CHEF_KEY_FILE" && \
+  step manage_nodes "" 120 3 "retrieve_script $CLOUD_MANAGE_NODES_FILE $MANAGE_NODES_FILE" && \
+  step recipe "" 120 3 "retrieve_script $CLOUD_RECIPE $RECIPE_FILE && add_healthz_resource" && \
+  step template "" 120 3 "retrieve_script $CLOUD_TEMPLATE $TEMPLATE_FILE" && \
+  step metadata "" 120 3 "retrieve_script $CLOUD_METADATA $METADATA_FILE" && \
+  step manage_fleet "" 60 2 install_manage_fleet && \
+  step configure "knife chef_key manage_nodes recipe template metadata" 300 0 configure_workstation && \
+  run_steps
+}
+
+function step() {
+  # Declare a boot step: step NAME "DEPENDENCIES" TIMEOUT RETRIES COMMAND
+  # Dependencies that were never declared (e.g. baked installs) count as done.
+  STEP_NAMES+=("$1")
+  STEP_DEPS[$1]="$2"
+  STEP_TIMEOUT[$1]="$3"
+  STEP_RETRIES[$1]="$4"
+  STEP_COMMAND[$1]="$5"
+}
+
+function kill_tree() {
+  for _child in $(pgrep -P "$1"); do
+    kill_tree "$_child"
+  done
+  kill -TERM "$1" 2> /dev/null || true
+}
+
+function run_step() {
+  # Run one step with its timeout and retries, then record its exit code
+  _name=$1
+  _log="$STEP_DIR/$_name.log"
+  _rc=1
+  _start=$(uptime_ms)
+  progress "$_name started"
+  for ((_attempt = 0; _attempt <= ${STEP_RETRIES[$_name]}; _attempt++)); do
+    [[ $_attempt -eq 0 ]] || sleep $((2 ** _attempt))
+    ( eval "${STEP_COMMAND[$_name]}" ) >> "$_log" 2>&1 &
+    _pid=$!
+    ( sleep "${STEP_TIMEOUT[$_name]}" && \
+      echo "timed out after ${STEP_TIMEOUT[$_name]}s" >> "$_log" && \
+      kill_tree $_pid ) &
+    _watchdog=$!
+    wait $_pid && _rc=0 || _rc=$?
+    kill_tree $_watchdog
+    [[ $_rc -ne 0 ]] || break
+  done
+  record_timing "$_name" $_start $(uptime_ms)
+  echo $_rc > "$STEP_DIR/$_name.rc"
+}
+
+function step_ready() {
+  for _dep in ${STEP_DEPS[$1]}; do
+    if [[ ! -z "${STEP_COMMAND[$_dep]+x}" && "${_state[$_dep]}" != "done" ]]; then
+      return 1
+    fi
+  done
+}
+
+function run_steps() {
+  # Run every declared step as soon as its dependencies are done. The first
+  # failure stops the others and is echoed for post_failure.
+  declare -A _state
+  declare -A _pids
+  rm -rf $STEP_DIR && mkdir -p $STEP_DIR
+  while true; do
+    for _name in "${STEP_NAMES[@]}"; do
+      if [[ -z "${_state[$_name]}" ]] && step_ready "$_name"; then
+        run_step "$_name" &
+        _pids[$_name]=$!
+        _state[$_name]="running"
+      fi
+    done
+
+    _running=0
+    _finished=0
+    for _name in "${STEP_NAMES[@]}"; do
+      [[ "${_state[$_name]}" == "running" ]] || continue
+      if [[ ! -f "$STEP_DIR/$_name.rc" ]]; then
+        _running=$((_running + 1))
+        continue
+      fi
+      wait ${_pids[$_name]} || true
+      if [[ $(cat "$STEP_DIR/$_name.rc") -ne 0 ]]; then
+        for _other in "${!_pids[@]}"; do
+          [[ "${_state[$_other]}" != "running" ]] || kill_tree ${_pids[$_other]}
+        done
+        echo "boot step $_name failed: $(tail -n 5 "$STEP_DIR/$_name.log")"
+        return 1
+      fi
+      _state[$_name]="done"
+      _finished=$((_finished + 1))
+    done
+
+    if [[ $_running -eq 0 && $_finished -eq 0 ]]; then
+      for _name in "${STEP_NAMES[@]}"; do
+        if [[ -z "${_state[$_name]}" ]]; then
+          echo "boot step $_name has unsatisfiable dependencies: ${STEP_DEPS[$_name]}"
+          return 1
+        fi
+      done
+      return 0
+    fi
+    [[ $_finished -gt 0 ]] || sleep 0.5
+  done
+}
+
+function check() {
+  # Declare a readiness check: check NAME COMMAND, where COMMAND exits 0 once
+  # NAME is ready. Roles declare theirs in custom_checks.
+  CHECK_NAMES+=("$1")
+  CHECK_COMMAND[$1]="$2"
+}
+
+function http_ready() {
+  # Probe an already running service instead of starting one to test it
+  curl -skf -o /dev/null --connect-timeout 1 --max-time 2 "$1"
+}
+
+function check_success() {
+  for _name in "${CHECK_NAMES[@]}"; do
+    if ! ( eval "${CHECK_COMMAND[$_name]}" ) > /dev/null 2>&1; then
+      echo "$_name not ready"
+      return 1
+    fi
+  done
+}
+
 function check_success_with_retries() {
+  custom_checks
   deadline="$(uptime_deadline)"
+  _delay=$CHECK_MIN_DELAY_MS
+  _last_message=""
   while [[ "$(uptime_seconds)" -lt "$deadline" ]]; do
     message=$(check_success)
     case $? in
@@ -223,11 +580,17 @@ function check_success_with_retries() {
         ;;
     esac
 
-    sleep 5
+    # A check that starts passing is progress; the same one failing is not.
+    [[ "$message" == "$_last_message" ]] || progress "check: $message"
+    _last_message="$message"
+
+    # Back off from CHECK_MIN_DELAY_MS, doubling up to CHECK_MAX_DELAY_MS
+    sleep "$((_delay / 1000)).$(printf '%03d' $((_delay % 1000)))"
+    _delay=$((_delay * 2 < CHECK_MAX_DELAY_MS ? _delay * 2 : CHECK_MAX_DELAY_MS))
   done
 
   # The check was not successful within the required deadline.
-  echo "status check timeout"
+  echo "status check timeout: $message"
   return 1
 }
 
@@ -236,39 +599,69 @@ function do_init() {
   echo "software-status: initializing..."
 
   set +e
+  _init_start=$(uptime_ms)
   message="$(custom_init)"
   result=$?
+  record_timing init $_init_start $(uptime_ms)
+  mkdir -p "$(dirname $INIT_STATUS_FILE)" && echo $result > $INIT_STATUS_FILE
   set -e
 
   if [[ $result -ne 0 ]]; then
     echo "software-status: init failure"
     post_failure "$message"
-    post_failure "$message" "status"
     return 1
   fi
 }
 
+function init_status() {
+  # Exit with do_init's status, which the startup-script wrapper checks before
+  # it installs the project ssh-keys
+  [[ -f $INIT_STATUS_FILE ]] && return "$(cat $INIT_STATUS_FILE)"
+}
+
 function do_check() {
   # Poll for success.
   echo "software-status: waiting for software to become ready..."
   set +e
+  _check_start=$(uptime_ms)
   message="$(check_success_with_retries)"
   result=$?
+  record_timing check $_check_start $(uptime_ms)
   set -e
 
   if [[ $result -eq 0 ]]; then
     echo "software-status: success"
     post_success
-    post_success "Success" "status"
   else
     echo "software-status: failed with message: $message"
     post_failure "$message"
-    post_failure "$message" "status"
   fi
 }
 
-# Run the initialization script synchronously.
-do_init || exit $?
+function do_bake() {
+  # Install the role's software only, so the disk can become a role image
+  echo "software-status: baking image..."
+  if install_software && touch $BAKED_MARKER; then
+    echo "software-status: bake complete"
+  else
+    echo "software-status: bake failed"
+    return 1
+  fi
+}
 
-# Run checks and drop them into the background as to not block the shell
-do_check & disown
+# The image pipeline sets bake-image; the image is built instead of a role.
+if bake_image; then
+  do_bake
+  exit $?
+fi
+
+# Watch for stalls from here until a status is posted.
+progress "boot"
+watch_progress & disown
+
+# Run the initialization script synchronously; the wrapper reads its result
+# with init_status.
+if do_init; then
+  # Run checks and drop them into the background as to not block the shell
+  do_check & disown
+fi
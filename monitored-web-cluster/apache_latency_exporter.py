@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Exports Apache request durations as Prometheus histograms.
+
+Tails the log that chef_apache2 writes with the request_duration format
+("%v %>s %D": vhost, final status and duration in microseconds) and serves
+apache_request_duration_seconds per vhost and status class on /metrics.
+"""
+import argparse
+import http.server
+import os
+import threading
+import time
+
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC = "apache_request_duration_seconds"
+
+
+class Histograms(object):
+  """Cumulative request duration histograms keyed by vhost and status class."""
+
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.lock = threading.Lock()
+    # (vhost, status_class) -> [per-bucket counts, count, sum]
+    self.series = {}
+    self.skipped = 0
+
+  def Observe(self, line):
+    """Records one log line, counting lines that do not parse as skipped."""
+    fields = line.split()
+    try:
+      vhost, status, micros = fields[-3], fields[-2], int(fields[-1])
+    except (IndexError, ValueError):
+      with self.lock:
+        self.skipped += 1
+      return
+    seconds = micros / 1e6
+    key = (vhost, status[:1] + "xx")
+    with self.lock:
+      counts = self.series.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+      for i, bound in enumerate(self.buckets):
+        if seconds <= bound:
+          counts[0][i] += 1
+      counts[1] += 1
+      counts[2] += seconds
+
+  def Render(self):
+    """Returns the histograms in the Prometheus text exposition format."""
+    lines = [
+        "# HELP {} Apache request duration from the %D access log.".format(
+            METRIC),
+        "# TYPE {} histogram".format(METRIC),
+    ]
+    with self.lock:
+      for (vhost, statusClass), (buckets, count, total) in sorted(
+          self.series.items()):
+        labels = 'vhost="{}",status_class="{}"'.format(
+            _Escape(vhost), statusClass)
+        for bound, bucketCount in zip(self.buckets, buckets):
+          lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+              METRIC, labels, bound, bucketCount))
+        lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(
+            METRIC, labels, count))
+        lines.append("{}_sum{{{}}} {}".format(METRIC, labels, total))
+        lines.append("{}_count{{{}}} {}".format(METRIC, labels, count))
+      lines.append("# HELP apache_request_log_skipped_total Log lines that "
+                   "did not parse.")
+      lines.append("# TYPE apache_request_log_skipped_total counter")
+      lines.append("apache_request_log_skipped_total {}".format(self.skipped))
+    return "\n".join(lines) + "\n"
+
+
+def _Escape(value):
+  """Escapes a label value for the text exposition format."""
+  return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _Rotated(path, log):
+  """Returns whether path now names a different or truncated file."""
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return False
+  return (stat.st_ino != os.fstat(log.fileno()).st_ino or
+          stat.st_size < log.tell())
+
+
+def Tail(path, histograms, interval):
+  """Feeds every line appended to path into histograms, across rotations.
+
+  The log may not exist yet, since Apache arrives with the first chef-client
+  run. Lines already in the file at startup are skipped; a rotated or newly
+  created file is read from the start, once the old one is read to its end.
+  """
+  log = None
+  fromStart = False
+  while True:
+    if log is None:
+      try:
+        log = open(path, "rb")
+      except (IOError, OSError):
+        fromStart = True
+        time.sleep(interval)
+        continue
+      if not fromStart:
+        log.seek(0, os.SEEK_END)
+    line = log.readline()
+    if line.endswith(b"\n"):
+      histograms.Observe(line.decode("utf-8", "replace"))
+      continue
+    if line:
+      # Partial line: rewind and wait for Apache to finish writing it.
+      log.seek(-len(line), os.SEEK_CUR)
+    if _Rotated(path, log):
+      # Lines written just before the rotation are still in the old file.
+      for line in log:
+        histograms.Observe(line.decode("utf-8", "replace"))
+      log.close()
+      log = None
+      fromStart = True
+      continue
+    time.sleep(interval)
+
+
+def _Handler(histograms):
+  """Returns a request handler class serving histograms on /metrics."""
+
+  class Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      if self.path != "/metrics":
+        self.send_error(404)
+        return
+      body = histograms.Render().encode("utf-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, *args):
+      pass
+
+  return Handler
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("--log", default="/var/log/apache2/request_duration.log")
+  parser.add_argument("--port", type=int, default=9118)
+  parser.add_argument("--interval", type=float, default=1.0,
+                      help="Seconds between polls of the log.")
+  args = parser.parse_args()
+
+  histograms = Histograms(BUCKETS)
+  tailer = threading.Thread(target=Tail,
+                            args=(args.log, histograms, args.interval))
+  tailer.daemon = True
+  tailer.start()
+  http.server.HTTPServer(("", args.port),
+                         _Handler(histograms)).serve_forever()
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,60 @@
+#!/bin/bash
+
+# Serves the deployment's pinned artifacts to chef-network, keyed by SHA256:
+#   http://<cache>/sha256/<sha256>
+# Clients fall back to the upstream URL on a miss, so a cold cache is safe.
+
+set -e
+
+CACHE_DIR="/var/www/html/sha256"
+ARTIFACTS=(
+  # chef-server-core 12.16.14
+  "4ab1655336588e0b7b67bc779bff648273d53fddb393831fcdc7d359339460af https://packages.chef.io/files/stable/chef-server/12.16.14/ubuntu/16.04/chef-server-core_12.16.14-1_amd64.deb"
+  # chefdk 3.1.0
+  "6c897581b151204b5ee28a905384a12e79fbe66445922cac5645d45fc3c23cd5 https://packages.chef.io/files/stable/chefdk/3.1.0/debian/9/chefdk_3.1.0-1_amd64.deb"
+  # go 1.9
+  "d70eadefce8e160638a9a6db97f7192d8463069ab33138893ad3bf31b0650a79 https://storage.googleapis.com/golang/go1.9.linux-amd64.tar.gz"
+  # prometheus 1.7.1
+  "4779d5cf08c50ed368a57b102ab3895e5e830d6b355ca4bfecf718a034a164e0 https://github.com/prometheus/prometheus/releases/download/v1.7.1/prometheus-1.7.1.linux-amd64.tar.gz"
+  # alertmanager 0.9.1
+  "407e0311689207b385fb1252f36d3c3119ae9a315e3eba205aaa69d576434ed7 https://github.com/prometheus/alertmanager/releases/download/v0.9.1/alertmanager-0.9.1.linux-amd64.tar.gz"
+  # node_exporter 0.15.2
+  "1ce667467e442d1f7fbfa7de29a8ffc3a7a0c84d24d7c695cc88b29e0752df37 https://github.com/prometheus/node_exporter/releases/download/v0.15.2/node_exporter-0.15.2.linux-amd64.tar.gz"
+  # blackbox_exporter 0.12.0
+  "c5d8ba7d91101524fa7c3f5e17256d467d44d5e1d243e251fd795e0ab4a83605 https://github.com/prometheus/blackbox_exporter/releases/download/v0.12.0/blackbox_exporter-0.12.0.linux-amd64.tar.gz"
+)
+
+function cache_artifact() {
+  # Download url ($2) and publish it under its sha256 ($1) once verified
+  _dest="$CACHE_DIR/$1"
+  [[ -f $_dest ]] && return 0
+  if wget -q -O "$_dest.part" "$2" && \
+    [[ $(sha256sum "$_dest.part" | awk '{print $1}') == "$1" ]]; then
+    mv "$_dest.part" "$_dest"
+  else
+    echo "artifact-cache: failed to cache $2"
+    rm -f "$_dest.part"
+    return 1
+  fi
+}
+
+function metadata_value() {
+  curl --retry 5 -sfH "Metadata-Flavor: Google" \
+    "http://metadata.google.internal/computeMetadata/v1/$1"
+}
+
+# The prebuilt apache exporter is pinned per deployment, not in this script.
+APACHE_EXPORTER_SHA256="$(metadata_value "instance/attributes/apache-exporter-sha256" || true)"
+if [[ ! -z "$APACHE_EXPORTER_SHA256" ]]; then
+  ARTIFACTS+=("$APACHE_EXPORTER_SHA256 $(metadata_value "instance/attributes/apache-exporter-url")")
+fi
+
+apt-get update && apt-get install -y nginx-light
+mkdir -p $CACHE_DIR
+
+for artifact in "${ARTIFACTS[@]}"; do
+  cache_artifact $artifact &
+done
+wait
+
+echo "artifact-cache: ready"
@@ -84,9 +84,7 @@ def GenerateConfig(context):
               'ports': ["1-65535"]
               },
               {'IPProtocol': 'ICMP'}]
-          },
-      'metadata':{
-          'dependsOn': [name]}
+          }
       },
       {
       'name': name + '-tcp-9090',
@@ -143,6 +141,20 @@ def GenerateConfig(context):
               'ports': ["9117"]
               }]
           }
+      },
+      {
+      'name': name + '-tcp-9118',
+      'type': 'compute.v1.firewall',
+      'properties':{
+          'network': '$(ref.{}.selfLink)'.format(name),
+          'sourceRanges': ["0.0.0.0/0"],
+          'targetTags': ["{}-tcp-9118".format(name)],
+          'allowed':[
+              {
+              'IPProtocol': 'TCP',
+              'ports': ["9118"]
+              }]
+          }
       }
 
   ]
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""Bootstraps or converges the web group's nodes in parallel.
+
+Runs on the chef workstation. The running instances of the web instance
+group are discovered through the compute API. Each node is then either
+bootstrapped with knife or converged with chef-client over SSH, with at most
+--concurrency nodes at a time. With --batch-size the fleet rolls in batches.
+A batch starts only while --min-healthy other nodes are HEALTHY behind the
+load balancer, and the next batch waits until this one is healthy again.
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+
+METADATA = "http://metadata.google.internal/computeMetadata/v1/"
+COMPUTE = "https://www.googleapis.com/compute/v1/projects/{}/"
+
+Node = collections.namedtuple("Node", ["name", "address", "url"])
+Result = collections.namedtuple("Result", ["node", "ok", "seconds"])
+
+
+class FleetError(Exception):
+  """An exception raised when the fleet cannot be rolled safely."""
+  pass
+
+
+def _Metadata(path):
+  """Returns a metadata server value of this workstation."""
+  request = urllib.request.Request(METADATA + path,
+                                   headers={"Metadata-Flavor": "Google"})
+  return urllib.request.urlopen(request).read().decode("utf-8")
+
+
+def _Api(url, body=None):
+  """Calls the compute API as the workstation's service account."""
+  token = json.loads(_Metadata(
+      "instance/service-accounts/default/token"))["access_token"]
+  data = None if body is None else json.dumps(body).encode("utf-8")
+  request = urllib.request.Request(url, data=data, headers={
+      "Authorization": "Bearer " + token,
+      "Content-Type": "application/json",
+  })
+  return json.loads(urllib.request.urlopen(request).read().decode("utf-8"))
+
+
+def _GroupUrl(args):
+  """Returns the instance group manager URL; a location without a zone
+  suffix (us-central1 rather than us-central1-f) names a regional group."""
+  if args.location.count("-") == 1:
+    scope = "regions/{}/regionInstanceGroupManagers".format(args.location)
+  else:
+    scope = "zones/{}/instanceGroupManagers".format(args.location)
+  return COMPUTE.format(args.project) + "{}/{}".format(scope, args.group)
+
+
+def Discover(args):
+  """Returns the group's running instances, sorted by name."""
+  managed = _Api(_GroupUrl(args) + "/listManagedInstances", body={})
+  nodes = []
+  for entry in managed.get("managedInstances", []):
+    if entry.get("instanceStatus") != "RUNNING":
+      continue
+    instance = _Api(entry["instance"])
+    nodes.append(Node(instance["name"],
+                      instance["networkInterfaces"][0]["networkIP"],
+                      entry["instance"]))
+  return sorted(nodes)
+
+
+def Healthy(args):
+  """Returns the URLs of the group's instances the load balancer sees as
+  HEALTHY."""
+  group = _Api(_GroupUrl(args))["instanceGroup"]
+  health = _Api(COMPUTE.format(args.project) +
+                "global/backendServices/{}/getHealth".format(
+                    args.backend_service), body={"group": group})
+  return set(status["instance"] for status in health.get("healthStatus", [])
+             if status.get("healthState") == "HEALTHY")
+
+
+def _Command(args, node):
+  """Returns the bootstrap or converge command line for one node."""
+  if args.action == "bootstrap":
+    return ["knife", "bootstrap", node.address,
+            "--config", args.knife_config,
+            "--ssh-user", args.ssh_user,
+            "--ssh-identity-file", args.identity_file,
+            "--sudo",
+            "--node-name", node.name,
+            "--run-list", args.run_list,
+            "--node-ssl-verify-mode", "none",
+            "--yes"]
+  return ["ssh", "-i", args.identity_file,
+          "-o", "BatchMode=yes",
+          "-o", "StrictHostKeyChecking=no",
+          "-o", "UserKnownHostsFile=/dev/null",
+          "{}@{}".format(args.ssh_user, node.address),
+          "sudo chef-client"]
+
+
+def Run(args, node):
+  """Runs the action on one node, logging to --log-dir/<node>.log."""
+  start = time.time()
+  with open(os.path.join(args.log_dir, node.name + ".log"), "w") as log:
+    try:
+      ok = subprocess.call(_Command(args, node), stdout=log,
+                           stderr=subprocess.STDOUT,
+                           timeout=args.timeout) == 0
+    except subprocess.TimeoutExpired:
+      log.write("\ntimed out after {}s\n".format(args.timeout))
+      ok = False
+  return Result(node, ok, time.time() - start)
+
+
+def RunAll(args, nodes):
+  """Runs the action on nodes, at most --concurrency at a time, and prints
+  each node's time as it finishes."""
+  results = []
+  with concurrent.futures.ThreadPoolExecutor(args.concurrency) as pool:
+    futures = [pool.submit(Run, args, node) for node in nodes]
+    for future in concurrent.futures.as_completed(futures):
+      result = future.result()
+      print("{:<40} {:<9} {:<6} {:>8.1f}s".format(
+          result.node.name, args.action, "ok" if result.ok else "FAILED",
+          result.seconds))
+      sys.stdout.flush()
+      results.append(result)
+  return results
+
+
+def _WaitFor(args, description, ready):
+  """Polls ready(healthy URLs) until it holds or --health-timeout passes."""
+  deadline = time.time() + args.health_timeout
+  while True:
+    healthy = Healthy(args)
+    if ready(healthy):
+      return
+    if time.time() > deadline:
+      raise FleetError("timed out waiting for " + description)
+    time.sleep(args.health_interval)
+
+
+def _MinHealthy(value, total):
+  """Parses --min-healthy, a node count or a percentage of the fleet."""
+  if value.endswith("%"):
+    return int(math.ceil(total * float(value[:-1]) / 100))
+  return int(value)
+
+
+def Roll(args, nodes):
+  """Runs the action batch by batch, keeping --min-healthy nodes serving."""
+  minHealthy = _MinHealthy(args.min_healthy, len(nodes))
+  if len(nodes) - args.batch_size < minHealthy:
+    raise FleetError("batches of {} leave fewer than {} of {} nodes "
+                     "serving".format(args.batch_size, minHealthy, len(nodes)))
+  results = []
+  for i in range(0, len(nodes), args.batch_size):
+    batch = nodes[i:i + args.batch_size]
+    urls = set(node.url for node in batch)
+    _WaitFor(args, "{} healthy nodes outside the batch".format(minHealthy),
+             lambda healthy: len(healthy - urls) >= minHealthy)
+    batchResults = RunAll(args, batch)
+    results.extend(batchResults)
+    if not all(result.ok for result in batchResults):
+      raise FleetError("batch failed, stopping the roll")
+    _WaitFor(args, "the batch to be healthy again",
+             lambda healthy: urls <= healthy)
+  return results
+
+
+def _Defaults(args):
+  """Fills unset arguments from the workstation's metadata."""
+  if not args.project:
+    args.project = _Metadata("project/project-id")
+  for name, key in [("group", "web-group"), ("location", "web-location"),
+                    ("backend_service", "web-backend-service")]:
+    if not getattr(args, name):
+      setattr(args, name, _Metadata("instance/attributes/" + key))
+  if not args.ssh_user:
+    # The project key belongs to the deployment user with - mapped to _
+    args.ssh_user = _Metadata("instance/attributes/username").replace("-", "_")
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+  parser.add_argument("action", choices=["bootstrap", "converge"])
+  parser.add_argument("--concurrency", type=int, default=10,
+                      help="Nodes to work on at the same time.")
+  parser.add_argument("--batch-size", type=int, default=0,
+                      help="Roll the fleet in batches of this many nodes; "
+                      "0 runs every node at once.")
+  parser.add_argument("--min-healthy", default="80%",
+                      help="Nodes, or a percentage of the fleet, that must "
+                      "stay HEALTHY while a batch runs.")
+  parser.add_argument("--health-timeout", type=int, default=600)
+  parser.add_argument("--health-interval", type=int, default=10)
+  parser.add_argument("--timeout", type=int, default=1200,
+                      help="Seconds allowed for one node.")
+  parser.add_argument("--run-list", default="recipe[chef_apache2]")
+  parser.add_argument("--knife-config", default="/share/.chef/knife.rb")
+  parser.add_argument("--identity-file", default="/share/project_key")
+  parser.add_argument("--log-dir", default="/share/fleet-logs")
+  parser.add_argument("--ssh-user")
+  parser.add_argument("--project")
+  parser.add_argument("--group")
+  parser.add_argument("--location",
+                      help="Zone of a zonal group or region of a regional one.")
+  parser.add_argument("--backend-service")
+  args = parser.parse_args()
+  _Defaults(args)
+
+  if not os.path.isdir(args.log_dir):
+    os.makedirs(args.log_dir)
+  start = time.time()
+  nodes = Discover(args)
+  print("{} {} nodes of {}".format(args.action, len(nodes), args.group))
+  try:
+    if args.batch_size > 0:
+      results = Roll(args, nodes)
+    else:
+      results = RunAll(args, nodes)
+  except FleetError as e:
+    print("error: {}".format(e))
+    return 1
+  failed = [result for result in results if not result.ok]
+  print("{} ok, {} failed in {:.1f}s; logs in {}".format(
+      len(results) - len(failed), len(failed), time.time() - start,
+      args.log_dir))
+  return 1 if failed else 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -3,6 +3,27 @@
 set -e
 
 DEFAULT_UPTIME_DEADLINE="300" # 5 minutes
+METADATA_CACHE="/run/chef-deployment/metadata"
+TIMINGS_FILE="/run/chef-deployment/timings"
+PROGRESS_FILE="/run/chef-deployment/progress"
+STATUS_POSTED="/run/chef-deployment/status-posted"
+INIT_STATUS_FILE="/run/chef-deployment/init-status"
+DEFAULT_STALL_WINDOW="300" # 5 minutes
+HEARTBEAT_SEC="15"
+BAKED_MARKER="/etc/chef-deployment-baked"
+STEP_DIR="/tmp/boot-steps"
+STEP_NAMES=()
+declare -A STEP_DEPS STEP_TIMEOUT STEP_RETRIES STEP_COMMAND
+CHECK_NAMES=()
+declare -A CHECK_COMMAND
+CHECK_MIN_DELAY_MS="250"
+CHECK_MAX_DELAY_MS="8000"
+NODE_EXPORTER_VERSION="node_exporter-0.15.2.linux-amd64"
+NODE_EXPORTER_SHA256="1ce667467e442d1f7fbfa7de29a8ffc3a7a0c84d24d7c695cc88b29e0752df37"
+NODE_EXPORTER_TAR="/tmp/${NODE_EXPORTER_VERSION}.tar.gz"
+NODE_EXPORTER_URL="https://github.com/prometheus/node_exporter/releases/download/v0.15.2/${NODE_EXPORTER_VERSION}.tar.gz"
+NODE_EXPORTER_DIR="/opt/${NODE_EXPORTER_VERSION}"
+NODE_EXPORTER_TAG="chef-network-tcp-9100"
 SHARE="/share"
 PRO_SHA256="4779d5cf08c50ed368a57b102ab3895e5e830d6b355ca4bfecf718a034a164e0"
 PROMETHEUS_VERSION="prometheus-1.7.1.linux-amd64"
@@ -14,25 +35,63 @@ ALERT_SHA256="407e0311689207b385fb1252f36d3c3119ae9a315e3eba205aaa69d576434ed7"
 ALERT_DIR="${SHARE}/${ALERT_VERSION}"
 ALERT_TAR="/tmp/${ALERT_VERSION}.tar.gz"
 ALERT_URL="https://github.com/prometheus/alertmanager/releases/download/v0.9.1/${ALERT_VERSION}.tar.gz"
+BLACKBOX_VERSION="blackbox_exporter-0.12.0.linux-amd64"
+BLACKBOX_SHA256="c5d8ba7d91101524fa7c3f5e17256d467d44d5e1d243e251fd795e0ab4a83605"
+BLACKBOX_DIR="${SHARE}/${BLACKBOX_VERSION}"
+BLACKBOX_TAR="/tmp/${BLACKBOX_VERSION}.tar.gz"
+BLACKBOX_URL="https://github.com/prometheus/blackbox_exporter/releases/download/v0.12.0/${BLACKBOX_VERSION}.tar.gz"
 CLOUD_PATH="project-edit-usr/5_7_1"
 PRO_YML_NAME="prometheus.yml"
-CLOUD_PRO_YML="${CLOUD_PATH}/${PRO_YML_NAME}"
 PRO_YML="${SHARE}/${PRO_YML_NAME}"
 ALERT_YML_NAME="alertmanager.yml"
 CLOUD_ALERT_YML="${CLOUD_PATH}/${ALERT_YML_NAME}"
 ALERT_YML="${SHARE}/${ALERT_YML_NAME}"
 RULES_CONF_NAME="rules.conf"
-CLOUD_RULES_CONF="${CLOUD_PATH}/${RULES_CONF_NAME}"
 RULES_CONF="${SHARE}/${RULES_CONF_NAME}"
+BLACKBOX_YML="${SHARE}/blackbox.yml"
+LB_TARGETS="${SHARE}/blackbox_lb.json"
+DATA_DISK="/dev/disk/by-id/google-prometheus-data"
+PRO_DATA="/mnt/prometheus-data"
+DEFAULT_RETENTION="360h"
 
-function metadata_value() {
+function fetch_metadata_value() {
   curl --retry 5 -sfH "Metadata-Flavor: Google" \
     "http://metadata.google.internal/computeMetadata/v1/$1"
 }
 
+function metadata_value() {
+  # Metadata is fixed for the boot: each key is fetched once and then read
+  # from $METADATA_CACHE, which every subshell and boot step shares.
+  _cached="$METADATA_CACHE/${1//\//_}"
+  if [[ ! -f "$_cached" ]]; then
+    # $BASHPID, not $$: concurrent boot steps are subshells of one script
+    _tmp="$_cached.$BASHPID"
+    mkdir -p "$METADATA_CACHE" && \
+    fetch_metadata_value "$1" > "$_tmp" && \
+    mv "$_tmp" "$_cached" || { rm -f "$_tmp"; return 1; }
+  fi
+  cat "$_cached"
+}
+
 function access_token() {
-  metadata_value "instance/service-accounts/default/token" \
-    | python -c "import sys, json; print json.load(sys.stdin)['access_token']"
+  # The OAuth token is cached as "EXPIRY TOKEN" until a minute before expiry.
+  _token_file="$METADATA_CACHE/access_token"
+  if [[ ! -f "$_token_file" || \
+    $(date +%s) -ge $(cut -d' ' -f1 "$_token_file") ]]; then
+    _json="$(fetch_metadata_value "instance/service-accounts/default/token")" \
+      || return 1
+    _re='"access_token": *"([^"]+)"'
+    [[ $_json =~ $_re ]] || return 1
+    _token="${BASH_REMATCH[1]}"
+    _re='"expires_in": *([0-9]+)'
+    [[ $_json =~ $_re ]] || return 1
+    _tmp="$_token_file.$BASHPID"
+    mkdir -p "$METADATA_CACHE" && \
+    ( umask 077 && \
+      echo "$(($(date +%s) + BASH_REMATCH[1] - 60)) $_token" > "$_tmp" ) && \
+    mv "$_tmp" "$_token_file"
+  fi
+  cut -d' ' -f2 "$_token_file"
 }
 
 function retrieve_script() {
@@ -41,6 +100,42 @@ function retrieve_script() {
     -o "${2}"
 }
 
+function artifact_cache_url() {
+  metadata_value "instance/attributes/artifact-cache-url" || true
+}
+
+function verify_sha256() {
+  [[ $(sha256sum "$1" | awk '{print $1}') == "$2" ]]
+}
+
+function fetch_artifact() {
+  # Fetch url ($1) pinned to sha256 ($2) into $3: the chef-network artifact
+  # cache first, the upstream url when the cache is unset, cold or wrong.
+  _cache="$(artifact_cache_url)"
+  if [[ ! -z "$_cache" ]] && \
+    heartbeat "$3" curl -sf --connect-timeout 2 "$_cache/sha256/$2" -o "$3" && \
+    verify_sha256 "$3" "$2"; then
+    return 0
+  fi
+  heartbeat "$3" wget -O "$3" "$1" && verify_sha256 "$3" "$2"
+}
+
+function heartbeat() {
+  # heartbeat PATH COMMAND...: run COMMAND and log the size of PATH whenever it
+  # grew, so a long download or build counts as boot step output while it moves
+  ( _size=""
+    while sleep $HEARTBEAT_SEC; do
+      _grown="$(du -sb "$1" 2> /dev/null | cut -f1)"
+      [[ -z "$_grown" || "$_grown" == "$_size" ]] || echo "$1: $_grown bytes"
+      _size="$_grown"
+    done ) &
+  _heartbeat=$!
+  _heartbeat_rc=0
+  "${@:2}" || _heartbeat_rc=$?
+  kill $_heartbeat 2> /dev/null || true
+  return $_heartbeat_rc
+}
+
 function uptime_seconds() {
   seconds="$(cat /proc/uptime | cut -d' ' -f1)"
   echo "${seconds%%.*}" # delete floating point.
@@ -62,6 +157,10 @@ function variable_path() {
   metadata_value "instance/attributes/status-variable-path"
 }
 
+function status_role() {
+  metadata_value "instance/attributes/status-role"
+}
+
 function project_name() {
   metadata_value "project/project-id"
 }
@@ -78,96 +177,623 @@ function config_name() {
   echo "${_config_name}"
 }
 
+function uptime_ms() {
+  # Milliseconds since boot: monotonic, unlike the wall clock
+  read _uptime _idle < /proc/uptime
+  echo $((10#${_uptime%.*} * 1000 + 10#${_uptime#*.} * 10))
+}
+
+function record_timing() {
+  # record_timing PHASE START_MS END_MS
+  mkdir -p "$(dirname $TIMINGS_FILE)" && echo "$1 $2 $3" >> $TIMINGS_FILE && \
+  progress "$1 done"
+}
+
+function timed() {
+  # timed PHASE COMMAND...: run COMMAND and record its span as PHASE
+  _timed_start=$(uptime_ms)
+  progress "$1 started"
+  _timed_rc=0
+  "${@:2}" || _timed_rc=$?
+  record_timing "$1" $_timed_start $(uptime_ms)
+  return $_timed_rc
+}
+
+function timings_json() {
+  # Every recorded phase, as published to <path>-timings/<instance id>
+  printf '{"host":"%s","phases":[' "$(hostname)"
+  _separator=""
+  while read _phase _start _end; do
+    printf '%s{"phase":"%s","startMs":%s,"endMs":%s,"durationMs":%s}' \
+      "$_separator" "$_phase" "$_start" "$_end" "$((_end - _start))"
+    _separator=","
+  done < <(cat $TIMINGS_FILE 2> /dev/null)
+  printf ']}'
+}
+
 function variable_body() {
-  encoded_value=$(echo "$2" | base64)
+  encoded_value=$(echo "$2" | base64 -w 0)
   printf '{"name":"%s", "value":"%s"}\n' "$1" "$encoded_value"
 }
 
 function post_result() {
-  var_subpath=$1
-  var_value=$2
-  var_path="$(config_name)/variables/$var_subpath/$(instance_id)"
+  # post_result SUBPATH VALUE [SUBPATH VALUE]... writes every variable in one
+  # curl call, so they share a single keep-alive connection.
+  _url="$(config_url)/variables"
+  _token="$(access_token)"
+  _args=()
+  while [[ $# -gt 1 ]]; do
+    [[ ${#_args[@]} -eq 0 ]] || _args+=(--next)
+    var_path="$(config_name)/variables/$1/$(instance_id)"
+    _args+=(--retry 5 -sH "Authorization: Bearer $_token" \
+      -H "Content-Type: application:json" \
+      -X POST -d "$(variable_body "$var_path" "$2")" "$_url")
+    shift 2
+  done
+  curl "${_args[@]}"
+}
+
+function wait_for_ssh_keys() {
+  # Print the project ssh-keys once the workstation has published the
+  # deployment user's keys, following metadata changes for at most $1 seconds.
+  _user="$(user_name | sed -e 's/-/_/g')"
+  _url="http://metadata.google.internal/computeMetadata/v1/project/attributes/ssh-keys"
+  _deadline=$((SECONDS + $1))
+  _etag=0
+  _keys=""
+  while [[ $SECONDS -lt $_deadline ]]; do
+    _headers="$(mktemp)"
+    _keys="$(curl -sf -D "$_headers" -H "Metadata-Flavor: Google" \
+      "$_url?wait_for_change=true&last_etag=$_etag&timeout_sec=$((_deadline - SECONDS))")" \
+      || true
+    _etag="$(awk 'tolower($1) == "etag:" {print $2}' "$_headers" | tr -d '\r')"
+    rm -f "$_headers"
+    if grep -q "^$_user:" <<< "$_keys"; then
+      echo "$_keys"
+      return 0
+    fi
+    # Without an etag there is no change to wait on, so poll instead.
+    [[ ! -z "$_etag" ]] || { _etag=0; sleep 1; }
+  done
+  echo "$_keys"
+  return 1
+}
+
+function bake_image() {
+  metadata_value "instance/attributes/bake-image" > /dev/null
+}
 
-  curl --retry 5 -sH "Authorization: Bearer $(access_token)" \
-    -H "Content-Type: application:json" \
-    -X POST -d "$(variable_body "$var_path" "$var_value")" \
-    "$(config_url)/variables"
+function is_baked() {
+  [[ -f $BAKED_MARKER ]]
 }
 
 function post_success() {
-  if [[ ! -z "$2" ]]; then
-    post_result "$2/success" "${1:-Success}"
-  else
-    post_result "$(variable_path)/success" "${1:-Success}"
-  fi
+  # Reports land in <path>/success/<role>/<instance id>, where the
+  # deployment's waiter for the role counts them.
+  mkdir -p "$(dirname $STATUS_POSTED)" && touch $STATUS_POSTED
+  post_result "$(variable_path)/success/$(status_role)" "${1:-Success}" \
+    "$(variable_path)-timings" "$(timings_json)"
 }
 
 function post_failure() {
-  if [[ ! -z "$2" ]]; then
-    post_result "$2/failure" "${1:-Failure}"
-  else
-    post_result "$(variable_path)/failure" "${1:-Failure}"
-  fi
+  mkdir -p "$(dirname $STATUS_POSTED)" && touch $STATUS_POSTED
+  post_result "$(variable_path)/failure/$(status_role)" "${1:-Failure}" \
+    "$(variable_path)-timings" "$(timings_json)"
 }
 
-function check_prometheus() {
-  # check the successful exection and teardown of prometheus
-  prometheus &
-  if [[ $? -eq 0 ]]; then
-    kill "$(ps aux | grep 'prometheus' | grep -v grep | awk '{print $2}')"
-  fi
+function progress() {
+  # Mark progress for watch_progress: progress DESCRIPTION
+  mkdir -p "$(dirname $PROGRESS_FILE)" && \
+  echo "$(uptime_ms) $*" >> $PROGRESS_FILE
 }
 
-function check_alertmanager() {
-  # check the successful exection and teardown of alertmanager
-  alertmanager &
-  if [[ $? -eq 0 ]]; then
-    kill "$(ps aux | grep 'alertmanager' | grep -v grep | awk '{print $2}')"
-  fi
+function stall_window() {
+  metadata_value "instance/attributes/status-stall-window" \
+    || echo $DEFAULT_STALL_WINDOW
 }
 
-function check_success() {
+function put_result() {
+  # Create or overwrite one variable: put_result SUBPATH VALUE
+  _name="$(config_name)/variables/$1/$(instance_id)"
+  _body="$(variable_body "$_name" "$2")"
+  _auth="Authorization: Bearer $(access_token)"
+  curl -sf -H "$_auth" -H "Content-Type: application/json" \
+    -X PUT -d "$_body" "https://runtimeconfig.googleapis.com/v1beta1/$_name" \
+    > /dev/null || \
+  curl -sf -H "$_auth" -H "Content-Type: application/json" \
+    -X POST -d "$_body" "$(config_url)/variables" > /dev/null
+}
+
+function stalled() {
+  # stalled WINDOW SINCE_MS: no progress mark since SINCE_MS and no boot step
+  # output for WINDOW seconds, even while a quiet step is still running
+  [[ $((($(uptime_ms) - $2) / 1000)) -ge $1 ]] && \
+  [[ -z "$(find $STEP_DIR -name '*.log' -newermt "$1 seconds ago" 2> /dev/null)" ]]
+}
+
+function watch_progress() {
+  # Publish each progress mark to <path>/progress/<instance id> and post a
+  # failure once the host stalls for the stall window, so the waiters fail
+  # fast instead of running into their timeout.
+  _window="$(stall_window)"
+  _last=""
+  while [[ ! -f $STATUS_POSTED ]]; do
+    _latest="$(tail -n 1 $PROGRESS_FILE 2> /dev/null)" || true
+    if [[ "$_latest" != "$_last" ]]; then
+      _last="$_latest"
+      put_result "$(variable_path)/progress" "${_latest#* }" || true
+    elif stalled $_window ${_latest%% *}; then
+      echo "software-status: stalled for ${_window}s after ${_latest#* }"
+      post_failure "stalled for ${_window}s after ${_latest#* }" || true
+      return 1
+    fi
+    sleep $HEARTBEAT_SEC
+  done
+}
+
+function custom_checks() {
   # custom success checks go here
-  [[ -f $PRO_YML ]] && \
-  [[ -f $ALERT_YML ]] && \
-  [[ -f $RULES_CONF ]] && \
-  check_prometheus && \
-  check_alertmanager
+  check prometheus_yml "[[ -f $PRO_YML ]]"
+  check alertmanager_yml "[[ -f $ALERT_YML ]]"
+  check rules_conf "[[ -f $RULES_CONF ]]"
+  check prometheus "http_ready http://localhost:9090/metrics"
+  check alertmanager "http_ready http://localhost:9093/metrics"
+  check blackbox "http_ready http://localhost:9115/metrics"
+  check node_exporter "http_ready http://localhost:9100/metrics"
 }
 
 function install_prometheus() {
   # Install Prometheus to /share
-  wget -O $PRO_TAR $PRO_URL && \
-  PRO_DOWN_SHA256=$(sha256sum $PRO_TAR | awk '{print $1}') && \
-  [[ $PRO_SHA256 == "$PRO_DOWN_SHA256" ]] && \
   tar xvfz $PRO_TAR -C $SHARE && \
-  retrieve_script $CLOUD_PRO_YML $PRO_YML && \
-  retrieve_script $CLOUD_RULES_CONF $RULES_CONF && \
   ln -s $PRO_DIR/prometheus /usr/bin
 }
 
 function install_alertmanager() {
   # Install Alertmanager to /share
-  wget -O $ALERT_TAR $ALERT_URL && \
-  ALERT_DOWN_SHA256=$(sha256sum $ALERT_TAR | awk '{print $1}') && \
-  [[ $ALERT_SHA256 == "$ALERT_DOWN_SHA256" ]] && \
   tar xvfz $ALERT_TAR -C $SHARE && \
-  retrieve_script $CLOUD_ALERT_YML $ALERT_YML && \
   ln -s $ALERT_DIR/alertmanager /usr/bin
 }
 
+function install_blackbox() {
+  # Install the blackbox prober to /share
+  tar xvfz $BLACKBOX_TAR -C $SHARE && \
+  ln -s $BLACKBOX_DIR/blackbox_exporter /usr/bin
+}
+
+function lb_address() {
+  # Prints the IP of the deployment's global forwarding rule once it exists
+  _url="https://www.googleapis.com/compute/v1/projects/$(project_name)/global/forwardingRules/$(metadata_value "instance/attributes/lb-forwarding-rule")"
+  _json="$(curl -sf -H "Authorization: Bearer $(access_token)" "$_url")" || return 1
+  _re='"IPAddress": *"([^"]+)"'
+  [[ $_json =~ $_re ]] && echo "${BASH_REMATCH[1]}"
+}
+
+function write_lb_targets() {
+  # The forwarding rule is created after the monitor, so its address is
+  # resolved in the background and reaches Prometheus through file_sd. It
+  # logs to /var/log/blackbox_lb_targets.log, away from the startup script's
+  # output, so the script can finish while the lookup continues.
+  for _attempt in $(seq 60); do
+    if _address="$(lb_address)"; then
+      echo "forwarding rule address: $_address"
+      printf '[{"targets": ["%s"]}]\n' "$_address" > $LB_TARGETS.$BASHPID && \
+      mv $LB_TARGETS.$BASHPID $LB_TARGETS
+      return
+    fi
+    echo "forwarding rule not ready, attempt $_attempt"
+    sleep 15
+  done
+  return 1
+}
+
+function probe_path() {
+  metadata_value "instance/attributes/probe-path"
+}
+
+function write_blackbox_yml() {
+  # One HTTP module serves both the load balancer and the backend probes,
+  # so their probe_duration_seconds are directly comparable.
+  {
+    printf 'modules:\n'
+    printf '  http_2xx:\n'
+    printf '    prober: http\n'
+    printf '    timeout: 5s\n'
+    printf '    http:\n'
+    printf '      preferred_ip_protocol: ip4\n'
+  } > $BLACKBOX_YML
+}
+
+function blackbox_relabel_configs() {
+  # Hands the scraped address to the local prober as its target URL
+  printf '      - source_labels: [__address__]\n'
+  printf "        regex: '(.+)'\n"
+  printf "        replacement: 'http://\${1}%s'\n" "$1"
+  printf '        target_label: __param_target\n'
+  printf '      - source_labels: [__param_target]\n'
+  printf '        target_label: target\n'
+  printf '      - target_label: __address__\n'
+  printf '        replacement: localhost:9115\n'
+}
+
+function prometheus_retention() {
+  metadata_value "instance/attributes/prometheus-retention" \
+    || echo $DEFAULT_RETENTION
+}
+
+function target_heap_size() {
+  # Prometheus 1.x should use about 2/3 of RAM for its heap, in bytes
+  echo $(($(awk '/^MemTotal:/ {print $2}' /proc/meminfo) * 1024 * 2 / 3))
+}
+
+function mount_data_disk() {
+  # Format the data disk on first boot only, then mount it at $PRO_DATA
+  if ! blkid $DATA_DISK > /dev/null; then
+    mkfs.ext4 -m 0 -F -E lazy_itable_init=0,lazy_journal_init=0,discard $DATA_DISK
+  fi
+  mkdir -p $PRO_DATA && \
+  { mountpoint -q $PRO_DATA || mount -o discard,defaults $DATA_DISK $PRO_DATA; } && \
+  { grep -q " $PRO_DATA " /etc/fstab || \
+    echo "UUID=$(blkid -s UUID -o value $DATA_DISK) $PRO_DATA ext4 discard,defaults,nofail 0 2" >> /etc/fstab; }
+}
+
+function scrape_zones() {
+  metadata_value "instance/attributes/scrape-zones" | tr ',' ' '
+}
+
+function scrape_tag() {
+  metadata_value "instance/attributes/scrape-tag"
+}
+
+function host_zones() {
+  # The web groups' zones plus the monitor's own, where the chef hosts run
+  { scrape_zones | tr ' ' '\n'; basename "$(metadata_value "instance/zone")"; } | sort -u
+}
+
+function gce_sd_configs() {
+  # gce_sd_configs PROJECT PORT ZONE...
+  _sd_project=$1
+  _sd_port=$2
+  shift 2
+  printf '    gce_sd_configs:\n'
+  for _zone in "$@"; do
+    printf '      - project: %s\n' "$_sd_project"
+    printf '        zone: %s\n' "$_zone"
+    printf '        port: %s\n' "$_sd_port"
+    printf '        refresh_interval: 30s\n'
+  done
+}
+
+function web_relabel_configs() {
+  # Keeps the web group instances carrying tag $1 and labels them by group
+  printf '    relabel_configs:\n'
+  printf '      - source_labels: [__meta_gce_tags]\n'
+  printf "        regex: '.*,%s,.*'\n" "$1"
+  printf '        action: keep\n'
+  printf '      - source_labels: [__meta_gce_metadata_created_by]\n'
+  printf "        regex: '.*/instanceGroupManagers/(.+)'\n"
+  printf '        action: keep\n'
+  printf '      - source_labels: [__meta_gce_metadata_created_by]\n'
+  printf "        regex: '.*/instanceGroupManagers/(.+)'\n"
+  printf '        target_label: instance_group\n'
+  printf '      - source_labels: [__meta_gce_zone]\n'
+  printf "        regex: '.*/zones/(.+)'\n"
+  printf '        target_label: zone\n'
+  printf '      - source_labels: [__meta_gce_instance_name]\n'
+  printf '        target_label: instance\n'
+}
+
+function alert_threshold() {
+  metadata_value "instance/attributes/alert-$1"
+}
+
+function recording_rule() {
+  # recording_rule NAME EXPRESSION
+  printf '%s = %s\n' "$1" "$2"
+}
+
+function write_rules_conf() {
+  # Recording rules pre-aggregate per instance group, so dashboards read a
+  # few series instead of every node's raw apache_* series; the alert
+  # thresholds come from the deployment.
+  _latency="$(alert_threshold latency-seconds)" && \
+  _busy="$(alert_threshold busy-workers-ratio)" && \
+  _up="$(alert_threshold targets-up-ratio)" && \
+  {
+    for _range in 1m 5m 1h; do
+      recording_rule "instance_group:apache_accesses:rate$_range" \
+        "sum(rate(apache_accesses_total[$_range])) by (instance_group)"
+      recording_rule "instance_group:apache_sent_kilobytes:rate$_range" \
+        "sum(rate(apache_sent_kilobytes_total[$_range])) by (instance_group)"
+    done
+    recording_rule "instance_group:apache_workers_busy:ratio" \
+      'sum(apache_workers{state="busy"}) by (instance_group) / sum(apache_workers) by (instance_group)'
+    for _range in 5m 1h; do
+      recording_rule "instance_group:apache_workers_busy:ratio_avg$_range" \
+        "avg_over_time(instance_group:apache_workers_busy:ratio[$_range])"
+      for _quantile in 50 95 99; do
+        recording_rule "instance_group:apache_request_duration_seconds:p${_quantile}_$_range" \
+          "histogram_quantile(0.$_quantile, sum(rate(apache_request_duration_seconds_bucket[$_range])) by (instance_group, le))"
+      done
+    done
+    recording_rule "instance_group:up:ratio" \
+      'avg(up{job="apache"}) by (instance_group)'
+    recording_rule "instance_group:apache_up:ratio" \
+      "avg(apache_up) by (instance_group)"
+    recording_rule "job:up:ratio" "avg(up) by (job)"
+    recording_rule "instance_group:chef_client_last_run_duration_seconds:max" \
+      "max(chef_client_last_run_duration_seconds) by (instance_group)"
+    for _range in 5m 1h; do
+      recording_rule "job:probe_duration_seconds:avg$_range" \
+        "avg(avg_over_time(probe_duration_seconds{job=~\"blackbox_.*\"}[$_range])) by (job)"
+      recording_rule "instance_group:probe_duration_seconds:avg$_range" \
+        "avg(avg_over_time(probe_duration_seconds{job=\"blackbox_backends\"}[$_range])) by (instance_group)"
+      recording_rule "lb:probe_overhead_seconds:avg$_range" \
+        "avg(avg_over_time(probe_duration_seconds{job=\"blackbox_lb\"}[$_range])) - avg(avg_over_time(probe_duration_seconds{job=\"blackbox_backends\"}[$_range]))"
+    done
+    printf '\n'
+    printf 'ALERT ApacheLatencyHigh\n'
+    printf '  IF instance_group:apache_request_duration_seconds:p95_5m > %s\n' "$_latency"
+    printf '  FOR 5m\n'
+    printf '  LABELS { severity = "page" }\n'
+    printf '  ANNOTATIONS { summary = "p95 latency of {{ $labels.instance_group }} above %ss" }\n' "$_latency"
+    printf '\n'
+    printf 'ALERT ApacheWorkersSaturated\n'
+    printf '  IF instance_group:apache_workers_busy:ratio_avg5m > %s\n' "$_busy"
+    printf '  FOR 5m\n'
+    printf '  LABELS { severity = "page" }\n'
+    printf '  ANNOTATIONS { summary = "{{ $labels.instance_group }} has more than %s of its workers busy" }\n' "$_busy"
+    printf '\n'
+    printf 'ALERT ScrapeTargetsDown\n'
+    printf '  IF instance_group:up:ratio < %s\n' "$_up"
+    printf '  FOR 5m\n'
+    printf '  LABELS { severity = "page" }\n'
+    printf '  ANNOTATIONS { summary = "less than %s of {{ $labels.instance_group }} is scraped" }\n' "$_up"
+  } > $RULES_CONF
+}
+
+function write_prometheus_yml() {
+  # Web nodes are found through GCE service discovery: every instance of an
+  # instance group carrying the scrape tag, so autoscaling needs no pushes.
+  # The node job scrapes node_exporter on every host with the 9100 tag, and
+  # the blackbox jobs probe the same path through the LB and on each node.
+  _project="$(project_name)" && \
+  _zones="$(scrape_zones)" && \
+  _tag="$(scrape_tag)" && \
+  _host_zones="$(host_zones)" && \
+  _probe_path="$(probe_path)" && \
+  {
+    printf 'global:\n'
+    printf '  scrape_interval: 15s\n'
+    printf '  evaluation_interval: 15s\n'
+    printf 'rule_files:\n'
+    printf '  - %s\n' "$RULES_CONF"
+    printf 'alerting:\n'
+    printf '  alertmanagers:\n'
+    printf '    - static_configs:\n'
+    printf '        - targets: [localhost:9093]\n'
+    printf 'scrape_configs:\n'
+    printf '  - job_name: prometheus\n'
+    printf '    static_configs:\n'
+    printf '      - targets: [localhost:9090]\n'
+    printf '  - job_name: apache\n'
+    gce_sd_configs "$_project" 9117 $_zones
+    web_relabel_configs "$_tag"
+    printf '  - job_name: apache_latency\n'
+    gce_sd_configs "$_project" 9118 $_zones
+    web_relabel_configs "$_tag"
+    printf '  - job_name: blackbox_lb\n'
+    printf '    metrics_path: /probe\n'
+    printf '    params:\n'
+    printf '      module: [http_2xx]\n'
+    printf '    file_sd_configs:\n'
+    printf '      - files: [%s]\n' "$LB_TARGETS"
+    printf '    relabel_configs:\n'
+    blackbox_relabel_configs "$_probe_path"
+    printf '  - job_name: blackbox_backends\n'
+    printf '    metrics_path: /probe\n'
+    printf '    params:\n'
+    printf '      module: [http_2xx]\n'
+    gce_sd_configs "$_project" 80 $_zones
+    web_relabel_configs "$_tag"
+    blackbox_relabel_configs "$_probe_path"
+    printf '  - job_name: node\n'
+    gce_sd_configs "$_project" 9100 $_host_zones
+    printf '    relabel_configs:\n'
+    printf '      - source_labels: [__meta_gce_tags]\n'
+    printf "        regex: '.*,%s,.*'\n" "$NODE_EXPORTER_TAG"
+    printf '        action: keep\n'
+    printf '      - source_labels: [__meta_gce_metadata_created_by]\n'
+    printf "        regex: '.*/instanceGroupManagers/(.+)'\n"
+    printf '        target_label: instance_group\n'
+    printf '      - source_labels: [__meta_gce_zone]\n'
+    printf "        regex: '.*/zones/(.+)'\n"
+    printf '        target_label: zone\n'
+    printf '      - source_labels: [__meta_gce_instance_name]\n'
+    printf '        target_label: instance\n'
+  } > $PRO_YML
+}
+
+function start_prometheus() {
+  start_daemon prometheus -config.file=$PRO_YML \
+    -storage.local.path=$PRO_DATA \
+    -storage.local.retention=$(prometheus_retention) \
+    -storage.local.target-heap-size=$(target_heap_size) \
+    -web.console.libraries=$PRO_DIR/console_libraries \
+    -web.console.templates=$PRO_DIR/consoles
+}
+
+function start_daemon() {
+  # Run "$@" detached from the startup script, logging to /var/log/$1.log
+  nohup "$@" >> "/var/log/$1.log" 2>&1 < /dev/null &
+}
+
+function install_node_exporter() {
+  # Host metrics on :9100, scraped by the monitor's node job
+  tar -C /opt -xzf $NODE_EXPORTER_TAR && \
+    ln -sf $NODE_EXPORTER_DIR/node_exporter /usr/bin
+}
+
+function install_steps() {
+  # steps baked into the prometheus-host role image
+  step fetch_prometheus "" 900 2 "fetch_artifact $PRO_URL $PRO_SHA256 $PRO_TAR"
+  step fetch_alertmanager "" 900 2 "fetch_artifact $ALERT_URL $ALERT_SHA256 $ALERT_TAR"
+  step install_prometheus "fetch_prometheus" 300 0 install_prometheus
+  step install_alertmanager "fetch_alertmanager" 300 0 install_alertmanager
+  step fetch_blackbox "" 900 2 "fetch_artifact $BLACKBOX_URL $BLACKBOX_SHA256 $BLACKBOX_TAR"
+  step install_blackbox "fetch_blackbox" 300 0 install_blackbox
+  step fetch_node_exporter "" 300 2 "fetch_artifact $NODE_EXPORTER_URL $NODE_EXPORTER_SHA256 $NODE_EXPORTER_TAR"
+  step install_node_exporter "fetch_node_exporter" 120 0 install_node_exporter
+}
+
+function install_software() {
+  # Run only the install steps, which bake-image turns into a role image
+  mkdir -p $SHARE && install_steps && run_steps
+}
+
 function custom_init() {
   # custom init commands go here
-  mkdir $SHARE && \
-  install_prometheus && \
-  install_alertmanager && \
+  mkdir -p $SHARE && \
+  { is_baked || install_steps; } && \
+  step prometheus_yml "" 60 0 write_prometheus_yml && \
+  step rules_conf "" 60 0 write_rules_conf && \
+  step blackbox_yml "" 60 0 write_blackbox_yml && \
+  step alertmanager_yml "" 120 3 "retrieve_script $CLOUD_ALERT_YML $ALERT_YML" && \
+  step data_disk "" 300 0 mount_data_disk && \
+  run_steps && \
   chgrp -R google-sudoers $SHARE && \
   chmod -R 777 $SHARE && \
-  chmod -R 777 $PRO_YML
+  chmod -R 777 $PRO_YML && \
+  start_prometheus && \
+  start_daemon alertmanager -config.file=$ALERT_YML \
+    -storage.path=$SHARE/alertmanager-data && \
+  start_daemon blackbox_exporter --config.file=$BLACKBOX_YML && \
+  { write_lb_targets >> /var/log/blackbox_lb_targets.log 2>&1 < /dev/null & \
+    disown; } && \
+  start_daemon node_exporter
+}
+
+function step() {
+  # Declare a boot step: step NAME "DEPENDENCIES" TIMEOUT RETRIES COMMAND
+  # Dependencies that were never declared (e.g. baked installs) count as done.
+  STEP_NAMES+=("$1")
+  STEP_DEPS[$1]="$2"
+  STEP_TIMEOUT[$1]="$3"
+  STEP_RETRIES[$1]="$4"
+  STEP_COMMAND[$1]="$5"
+}
+
+function kill_tree() {
+  for _child in $(pgrep -P "$1"); do
+    kill_tree "$_child"
+  done
+  kill -TERM "$1" 2> /dev/null || true
+}
+
+function run_step() {
+  # Run one step with its timeout and retries, then record its exit code
+  _name=$1
+  _log="$STEP_DIR/$_name.log"
+  _rc=1
+  _start=$(uptime_ms)
+  progress "$_name started"
+  for ((_attempt = 0; _attempt <= ${STEP_RETRIES[$_name]}; _attempt++)); do
+    [[ $_attempt -eq 0 ]] || sleep $((2 ** _attempt))
+    ( eval "${STEP_COMMAND[$_name]}" ) >> "$_log" 2>&1 &
+    _pid=$!
+    ( sleep "${STEP_TIMEOUT[$_name]}" && \
+      echo "timed out after ${STEP_TIMEOUT[$_name]}s" >> "$_log" && \
+      kill_tree $_pid ) &
+    _watchdog=$!
+    wait $_pid && _rc=0 || _rc=$?
+    kill_tree $_watchdog
+    [[ $_rc -ne 0 ]] || break
+  done
+  record_timing "$_name" $_start $(uptime_ms)
+  echo $_rc > "$STEP_DIR/$_name.rc"
+}
+
+function step_ready() {
+  for _dep in ${STEP_DEPS[$1]}; do
+    if [[ ! -z "${STEP_COMMAND[$_dep]+x}" && "${_state[$_dep]}" != "done" ]]; then
+      return 1
+    fi
+  done
+}
+
+function run_steps() {
+  # Run every declared step as soon as its dependencies are done. The first
+  # failure stops the others and is echoed for post_failure.
+  declare -A _state
+  declare -A _pids
+  rm -rf $STEP_DIR && mkdir -p $STEP_DIR
+  while true; do
+    for _name in "${STEP_NAMES[@]}"; do
+      if [[ -z "${_state[$_name]}" ]] && step_ready "$_name"; then
+        run_step "$_name" &
+        _pids[$_name]=$!
+        _state[$_name]="running"
+      fi
+    done
+
+    _running=0
+    _finished=0
+    for _name in "${STEP_NAMES[@]}"; do
+      [[ "${_state[$_name]}" == "running" ]] || continue
+      if [[ ! -f "$STEP_DIR/$_name.rc" ]]; then
+        _running=$((_running + 1))
+        continue
+      fi
+      wait ${_pids[$_name]} || true
+      if [[ $(cat "$STEP_DIR/$_name.rc") -ne 0 ]]; then
+        for _other in "${!_pids[@]}"; do
+          [[ "${_state[$_other]}" != "running" ]] || kill_tree ${_pids[$_other]}
+        done
+        echo "boot step $_name failed: $(tail -n 5 "$STEP_DIR/$_name.log")"
+        return 1
+      fi
+      _state[$_name]="done"
+      _finished=$((_finished + 1))
+    done
+
+    if [[ $_running -eq 0 && $_finished -eq 0 ]]; then
+      for _name in "${STEP_NAMES[@]}"; do
+        if [[ -z "${_state[$_name]}" ]]; then
+          echo "boot step $_name has unsatisfiable dependencies: ${STEP_DEPS[$_name]}"
+          return 1
+        fi
+      done
+      return 0
+    fi
+    [[ $_finished -gt 0 ]] || sleep 0.5
+  done
+}
+
+function check() {
+  # Declare a readiness check: check NAME COMMAND, where COMMAND exits 0 once
+  # NAME is ready. Roles declare theirs in custom_checks.
+  CHECK_NAMES+=("$1")
+  CHECK_COMMAND[$1]="$2"
+}
+
+function http_ready() {
+  # Probe an already running service instead of starting one to test it
+  curl -skf -o /dev/null --connect-timeout 1 --max-time 2 "$1"
+}
+
+function check_success() {
+  for _name in "${CHECK_NAMES[@]}"; do
+    if ! ( eval "${CHECK_COMMAND[$_name]}" ) > /dev/null 2>&1; then
+      echo "$_name not ready"
+      return 1
+    fi
+  done
 }
 
 function check_success_with_retries() {
+  custom_checks
   deadline="$(uptime_deadline)"
+  _delay=$CHECK_MIN_DELAY_MS
+  _last_message=""
   while [[ "$(uptime_seconds)" -lt "$deadline" ]]; do
     message=$(check_success)
     case $? in
@@ -185,11 +811,17 @@ function check_success_with_retries() {
         ;;
     esac
 
-    sleep 5
+    # A check that starts passing is progress; the same one failing is not.
+    [[ "$message" == "$_last_message" ]] || progress "check: $message"
+    _last_message="$message"
+
+    # Back off from CHECK_MIN_DELAY_MS, doubling up to CHECK_MAX_DELAY_MS
+    sleep "$((_delay / 1000)).$(printf '%03d' $((_delay % 1000)))"
+    _delay=$((_delay * 2 < CHECK_MAX_DELAY_MS ? _delay * 2 : CHECK_MAX_DELAY_MS))
   done
 
   # The check was not successful within the required deadline.
-  echo "status check timeout"
+  echo "status check timeout: $message"
   return 1
 }
 
@@ -198,39 +830,69 @@ function do_init() {
   echo "software-status: initializing..."
 
   set +e
+  _init_start=$(uptime_ms)
   message="$(custom_init)"
   result=$?
+  record_timing init $_init_start $(uptime_ms)
+  mkdir -p "$(dirname $INIT_STATUS_FILE)" && echo $result > $INIT_STATUS_FILE
   set -e
 
   if [[ $result -ne 0 ]]; then
     echo "software-status: init failure"
     post_failure "$message"
-    post_failure "$message" "status"
     return 1
   fi
 }
 
+function init_status() {
+  # Exit with do_init's status, which the startup-script wrapper checks before
+  # it installs the project ssh-keys
+  [[ -f $INIT_STATUS_FILE ]] && return "$(cat $INIT_STATUS_FILE)"
+}
+
 function do_check() {
   # Poll for success.
   echo "software-status: waiting for software to become ready..."
   set +e
+  _check_start=$(uptime_ms)
   message="$(check_success_with_retries)"
   result=$?
+  record_timing check $_check_start $(uptime_ms)
   set -e
 
   if [[ $result -eq 0 ]]; then
     echo "software-status: success"
     post_success
-    post_success "Success" "status"
   else
     echo "software-status: failed with message: $message"
     post_failure "$message"
-    post_failure "$message" "status"
   fi
 }
 
-# Run the initialization script synchronously.
-do_init || exit $?
+function do_bake() {
+  # Install the role's software only, so the disk can become a role image
+  echo "software-status: baking image..."
+  if install_software && touch $BAKED_MARKER; then
+    echo "software-status: bake complete"
+  else
+    echo "software-status: bake failed"
+    return 1
+  fi
+}
 
-# Run checks and drop them into the background as to not block the shell
-do_check & disown
+# The image pipeline sets bake-image; the image is built instead of a role.
+if bake_image; then
+  do_bake
+  exit $?
+fi
+
+# Watch for stalls from here until a status is posted.
+progress "boot"
+watch_progress & disown
+
+# Run the initialization script synchronously; the wrapper reads its result
+# with init_status.
+if do_init; then
+  # Run checks and drop them into the background as to not block the shell
+  do_check & disown
+fi
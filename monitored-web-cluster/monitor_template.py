@@ -1,5 +1,52 @@
 """Creates a GCE instance template for Windows"""
 import json
+import profiles
+
+
+class PropertyError(Exception):
+    """An exception raised when property values are invalid."""
+    pass
+
+
+def _AlertThreshold(context, key, default):
+    """Returns an alert threshold property, which must be a positive number."""
+    value = context.properties.get(key)
+    if value in (None, ""):
+        value = default
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise PropertyError('Invalid {} value: {}'.format(key, value))
+    if value <= 0:
+        raise PropertyError('{} must be greater than 0, got {}'.format(key, value))
+    return str(value)
+
+
+def _DataDisk(context, project, zone):
+    """Returns the Prometheus data disk, mounted by the startup script."""
+    return {
+        'deviceName': 'prometheus-data',
+        'type': 'PERSISTENT',
+        'autoDelete': True,
+        'initializeParams': {
+            'diskName': '{}-data'.format(context.env['name']),
+            'diskType': 'https://www.googleapis.com/compute/v1'
+            '/projects/{}/zones/{}/diskTypes/{}'.format(
+                project, zone, context.properties.get("dataDiskType") or "pd-ssd"),
+            'diskSizeGb': int(context.properties.get("dataDiskSizeGb") or 50)
+        }
+    }
+
+
+def _SourceImage(context):
+    """Returns the boot image: sourceImage, imageFamily or stock debian-9."""
+    if context.properties.get("sourceImage"):
+        return context.properties["sourceImage"]
+    if context.properties.get("imageFamily"):
+        return 'projects/{}/global/images/family/{}'.format(
+            context.env["project"], context.properties["imageFamily"])
+    return 'projects/debian-cloud/global/images/family/debian-9'
+
 
 def GenerateConfig(context):
     
@@ -16,6 +63,8 @@ def GenerateConfig(context):
     statusVariablePath = context.properties["statusVariablePath"]
     statusUptimeDeadline = context.properties["statusUptimeDeadline"]
 
+    sizing = profiles.Sizing(context, 'monitor')
+
     resources = []
 
     resources.append({
@@ -24,19 +73,21 @@ def GenerateConfig(context):
         'properties': {
             'zone': context.properties['zone'],
             'machineType': 'https://www.googleapis.com/compute/v1/projects/{}'
-                '/zones/{}/machineTypes/{}'.format(project, zone,'n1-standard-1'),
+                '/zones/{}/machineTypes/{}'.format(project, zone,
+                                                 sizing['machineType']),
             'disks': [{
                 'deviceName': 'boot',
                 'type': 'PERSISTENT',
                 'boot': True,
                 'autoDelete': True,
                 'initializeParams': {
-                    'sourceImage': 'projects/debian-cloud/global/images/family/debian-9',
+                    'sourceImage': _SourceImage(context),
                     'diskType': 'https://www.googleapis.com/compute/v1'
-                    '/projects/{}/zones/{}/diskTypes/pd-standard'.format(project, zone),
-                    'diskSizeGb':10
+                    '/projects/{}/zones/{}/diskTypes/{}'.format(
+                        project, zone, sizing['diskType']),
+                    'diskSizeGb': sizing['diskSizeGb']
                 }
-            }],
+            }, _DataDisk(context, project, zone)],
             'networkInterfaces': [{
                               'network': '$(ref.{}.selfLink)'.format(network),
                               'subnetwork': '$(ref.{}-subnet.selfLink)'.format(network),
@@ -50,7 +101,7 @@ def GenerateConfig(context):
               'email': 'default',
               'scopes': ['https://www.googleapis.com/auth/cloud-platform']
             }],
-            'tags': {'items': ["ssh-server", "http-server", "chef-network-tcp-9090", "chef-network-tcp-9117", "chef-network-tcp-9093"]},
+            'tags': {'items': ["ssh-server", "http-server", "chef-network-tcp-9090", "chef-network-tcp-9117", "chef-network-tcp-9093", "chef-network-tcp-9100"]},
             'metadata': {
                 'items': [{
                           'key': 'startup-script',
@@ -65,10 +116,8 @@ def GenerateConfig(context):
                                 chmod -R go-rwx ~{username}/.ssh
                                 echo "Done adding new user {username}"
                                 {context}
-                                result=$?
-                                sleep 30
-                                if [ $result -eq 0 ]; then
-                                  curl --connect-timeout 10 --max-time 5 --retry 5 --retry-delay 0 --retry-max-time 60 -sfH "Metadata-Flavor: Google" "http://metadata.google.internal/computeMetadata/v1/project/attributes/ssh-keys" | python3 -c "import sys; [print(k) for k in [key.strip().split(':')[-1] for key in sys.stdin.readlines()]]" >> ~{username}/.ssh/authorized_keys
+                                if init_status; then
+                                  wait_for_ssh_keys 30 | python3 -c "import sys; [print(k) for k in [key.strip().split(':')[-1] for key in sys.stdin.readlines()]]" >> ~{username}/.ssh/authorized_keys
                                 fi
                                 """.format(
                                     username = username,
@@ -90,36 +139,56 @@ def GenerateConfig(context):
                           'value': statusVariablePath
                           },
                           {
+                          'key': 'status-role',
+                          'value': 'monitor'
+                          },
+                          {
                           'key': 'status-uptime-deadline',
                           'value': statusUptimeDeadline
+                          },
+                          {
+                          'key': 'status-stall-window',
+                          'value': context.properties.get("statusStallWindow", 300)
+                          },
+                          {
+                          'key': 'artifact-cache-url',
+                          'value': context.properties.get("artifactCacheUrl", "")
+                          },
+                          {
+                          'key': 'scrape-zones',
+                          'value': ','.join(context.properties.get("scrapeZones") or [zone])
+                          },
+                          {
+                          'key': 'scrape-tag',
+                          'value': context.properties.get("scrapeTag") or "{}-tcp-9117".format(network)
+                          },
+                          {
+                          'key': 'alert-latency-seconds',
+                          'value': _AlertThreshold(context, "alertLatencySec", 0.5)
+                          },
+                          {
+                          'key': 'alert-busy-workers-ratio',
+                          'value': _AlertThreshold(context, "alertBusyWorkersRatio", 0.8)
+                          },
+                          {
+                          'key': 'alert-targets-up-ratio',
+                          'value': _AlertThreshold(context, "alertTargetsUpRatio", 0.8)
+                          },
+                          {
+                          'key': 'lb-forwarding-rule',
+                          'value': '{}-forwarding'.format(deployment)
+                          },
+                          {
+                          'key': 'probe-path',
+                          'value': context.properties.get("probePath") or "/"
+                          },
+                          {
+                          'key': 'prometheus-retention',
+                          'value': context.properties.get("retention") or "360h"
                           }]
             }
         }
     })
     
-    resources.append({
-      'name': "{}-waiter".format(context.env['name']),
-      'type': 'runtimeconfig.v1beta1.waiter',
-      'metadata': {
-          'dependsOn': [context.env['name']],
-      },
-      'properties': {
-          'parent': '$(ref.{}-config.name)'.format(context.env["deployment"]),
-          'waiter': "{}-waiter".format(context.env['name']),
-          'timeout': '{}s'.format(statusUptimeDeadline),
-          'success': {
-              'cardinality': {
-                  'number': 1,
-                  'path': '{}/success'.format(statusVariablePath),
-              },
-          },
-          'failure': {
-              'cardinality': {
-                  'number': 1,
-                  'path': '{}/failure'.format(statusVariablePath),
-              },
-          },
-      },
-    })
 
     return {'resources': resources}
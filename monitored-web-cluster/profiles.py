@@ -0,0 +1,44 @@
+"""Machine sizes per role and profile, shared by the role templates."""
+
+# The machineType, diskType and diskSizeGb properties override the chosen
+# profile's values.
+PROFILES = {
+  'server': {
+    'small': {'machineType': 'n1-standard-1', 'diskType': 'pd-standard', 'diskSizeGb': 10},
+    'medium': {'machineType': 'n1-standard-4', 'diskType': 'pd-ssd', 'diskSizeGb': 50},
+    'large': {'machineType': 'n1-standard-8', 'diskType': 'pd-ssd', 'diskSizeGb': 100},
+  },
+  'workstation': {
+    'small': {'machineType': 'n1-standard-1', 'diskType': 'pd-standard', 'diskSizeGb': 10},
+    'medium': {'machineType': 'n1-standard-2', 'diskType': 'pd-standard', 'diskSizeGb': 20},
+    'large': {'machineType': 'n1-standard-4', 'diskType': 'pd-ssd', 'diskSizeGb': 50},
+  },
+  'monitor': {
+    'small': {'machineType': 'n1-standard-1', 'diskType': 'pd-standard', 'diskSizeGb': 10},
+    'medium': {'machineType': 'n1-standard-2', 'diskType': 'pd-ssd', 'diskSizeGb': 50},
+    'large': {'machineType': 'n1-highmem-4', 'diskType': 'pd-ssd', 'diskSizeGb': 200},
+  },
+  'node': {
+    'small': {'machineType': 'g1-small', 'diskType': 'pd-standard', 'diskSizeGb': 10},
+    'medium': {'machineType': 'n1-standard-1', 'diskType': 'pd-standard', 'diskSizeGb': 10},
+    'large': {'machineType': 'n1-standard-2', 'diskType': 'pd-ssd', 'diskSizeGb': 20},
+  },
+}
+
+
+class PropertyError(Exception):
+  """An exception raised when property values are invalid."""
+  pass
+
+
+def Sizing(context, role):
+  """Returns the machineType, diskType and diskSizeGb of a role."""
+  profile = context.properties.get("profile") or "small"
+  if profile not in PROFILES[role]:
+    raise PropertyError('Invalid profile value: {}'.format(profile))
+  sizing = dict(PROFILES[role][profile])
+  for key in sizing:
+    if context.properties.get(key):
+      sizing[key] = context.properties[key]
+  sizing['diskSizeGb'] = int(sizing['diskSizeGb'])
+  return sizing
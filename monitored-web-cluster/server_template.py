@@ -1,4 +1,16 @@
 """Creates a GCE instance template for Windows"""
+import profiles
+
+
+def _SourceImage(context):
+    """Returns the boot image: sourceImage, imageFamily or stock debian-9."""
+    if context.properties.get("sourceImage"):
+        return context.properties["sourceImage"]
+    if context.properties.get("imageFamily"):
+        return 'projects/{}/global/images/family/{}'.format(
+            context.env["project"], context.properties["imageFamily"])
+    return 'projects/debian-cloud/global/images/family/debian-9'
+
 
 def GenerateConfig(context):
     
@@ -15,6 +27,8 @@ def GenerateConfig(context):
     statusVariablePath = context.properties["statusVariablePath"]
     statusUptimeDeadline = context.properties["statusUptimeDeadline"]
 
+    sizing = profiles.Sizing(context, 'server')
+
     resources = []
 
     resources.append({
@@ -23,17 +37,19 @@ def GenerateConfig(context):
         'properties': {
             'zone': context.properties['zone'],
             'machineType': 'https://www.googleapis.com/compute/v1/projects/{}'
-                '/zones/{}/machineTypes/{}'.format(project, zone,'n1-standard-1'),
+                '/zones/{}/machineTypes/{}'.format(project, zone,
+                                                 sizing['machineType']),
             'disks': [{
                 'deviceName': 'boot',
                 'type': 'PERSISTENT',
                 'boot': True,
                 'autoDelete': True,
                 'initializeParams': {
-                    'sourceImage': 'projects/debian-cloud/global/images/family/debian-9',
+                    'sourceImage': _SourceImage(context),
                     'diskType': 'https://www.googleapis.com/compute/v1'
-                    '/projects/{}/zones/{}/diskTypes/pd-standard'.format(project, zone),
-                    'diskSizeGb':10
+                    '/projects/{}/zones/{}/diskTypes/{}'.format(
+                        project, zone, sizing['diskType']),
+                    'diskSizeGb': sizing['diskSizeGb']
                 }
             }],
             'networkInterfaces': [{
@@ -49,7 +65,7 @@ def GenerateConfig(context):
               'email': 'default',
               'scopes': ['https://www.googleapis.com/auth/cloud-platform']
             }],
-            'tags': {'items': ["http-server", "ssh-server", "chef-network-tcp-9090", "chef-network-tcp-9117", "all-ports"]},
+            'tags': {'items': ["http-server", "ssh-server", "chef-network-tcp-9090", "chef-network-tcp-9117", "chef-network-tcp-9100", "all-ports"]},
             'metadata': {
                 'items': [{
                           'key': 'startup-script',
@@ -64,10 +80,8 @@ def GenerateConfig(context):
                                 chmod -R go-rwx ~{username}/.ssh
                                 echo "Done adding new user {username}"
                                 {context}
-                                result=$?
-                                sleep 30
-                                if [ $result -eq 0 ]; then
-                                  curl --connect-timeout 10 --max-time 5 --retry 5 --retry-delay 0 --retry-max-time 60 -sfH "Metadata-Flavor: Google" "http://metadata.google.internal/computeMetadata/v1/project/attributes/ssh-keys" | python3 -c "import sys; [print(k) for k in [key.strip().split(':')[-1] for key in sys.stdin.readlines()]]" >> ~{username}/.ssh/authorized_keys
+                                if init_status; then
+                                  wait_for_ssh_keys 30 | python3 -c "import sys; [print(k) for k in [key.strip().split(':')[-1] for key in sys.stdin.readlines()]]" >> ~{username}/.ssh/authorized_keys
                                 fi
                                 """.format(
                                     username = username,
@@ -90,36 +104,23 @@ def GenerateConfig(context):
                           'value': statusVariablePath
                           },
                           {
+                          'key': 'status-role',
+                          'value': 'server'
+                          },
+                          {
                           'key': 'status-uptime-deadline',
                           'value': statusUptimeDeadline
+                          },
+                          {
+                          'key': 'status-stall-window',
+                          'value': context.properties.get("statusStallWindow", 300)
+                          },
+                          {
+                          'key': 'artifact-cache-url',
+                          'value': context.properties.get("artifactCacheUrl", "")
                           }]
             }
         }
     })
 
-    resources.append({
-      'name': "{}-waiter".format(context.env['name']),
-      'type': 'runtimeconfig.v1beta1.waiter',
-      'metadata': {
-          'dependsOn': [context.env['name']],
-      },
-      'properties': {
-          'parent': '$(ref.{}-config.name)'.format(context.env["deployment"]),
-          'waiter': "{}-waiter".format(context.env['name']),
-          'timeout': '{}s'.format(statusUptimeDeadline),
-          'success': {
-              'cardinality': {
-                  'number': 1,
-                  'path': '{}/success'.format(statusVariablePath),
-              },
-          },
-          'failure': {
-              'cardinality': {
-                  'number': 1,
-                  'path': '{}/failure'.format(statusVariablePath),
-              },
-          },
-      },
-    })
-
     return {'resources': resources}
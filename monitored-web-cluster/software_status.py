@@ -22,12 +22,12 @@ def _ConfigUrl(context):
       config=_ConfigName(context))
 
 
-def _WaiterName(context):
-  """Returns the short waiter name."""
+def _WaiterName(context, role):
+  """Returns the short waiter name of a role."""
   # This name is only used for the DM manifest entry. The actual waiter name
-  # within RuntimeConfig is static, as it is scoped to the config resource.
+  # within RuntimeConfig is software-<role>, scoped to the config resource.
   deployment = context.properties["deployment"]
-  return '{}-waiter'.format(deployment)
+  return '{}-waiter-{}'.format(deployment, role)
 
 
 def _Timeout(context):
@@ -40,17 +40,26 @@ def _Timeout(context):
     raise PropertyError('Invalid timeout value: {}'.format(timeout))
 
 
-def _SuccessNumber(context):
-  """Returns the successNumber property or a default value if unspecified."""
-  successNumber = 8
-  number = successNumber
-  try:
-    number = int(number)
-    if number < 1:
-      raise PropertyError('successNumber value must be greater than 0.')
-    return number
-  except ValueError:
-    raise PropertyError('Invalid successNumber value: {}'.format(number))
+def _RoleCounts(context):
+  """Returns (role, host count) for every role that must report success.
+
+  The roles property maps each role to its host count, as rendered by the
+  deployment; every host reports under {statusPath}/success/<role>.
+  """
+  roles = context.properties["roles"]
+  counts = []
+  for role, count in sorted(roles.items()):
+    try:
+      count = int(count)
+    except (TypeError, ValueError):
+      raise PropertyError('Invalid host count for {}: {}'.format(role, count))
+    if count < 0:
+      raise PropertyError('Host count for {} must not be negative.'.format(role))
+    if count > 0:
+      counts.append((role, count))
+  if not counts:
+    raise PropertyError('successNumber value must be greater than 0.')
+  return counts
 
 
 def _FailureNumber(context):
@@ -68,7 +77,9 @@ def _FailureNumber(context):
 
 def _WaiterDependsOn(context):
   """Returns the waiterDependsOn property or an empty list if unspecified."""
-  waiterDependsOn = context.properties["waiterDependsOn"]
+  # The waiter only needs its parent config; hosts report readiness through
+  # RuntimeConfig variables, so extra edges here just serialize the rollout.
+  waiterDependsOn = context.properties.get("waiterDependsOn", [])
 
   return waiterDependsOn
 
@@ -87,24 +98,29 @@ def _RuntimeConfig(context):
   }
 
 
-def _Waiter(context):
-  """Constructs a waiter resource."""
+def _Waiter(context, role, number):
+  """Constructs the waiter resource of one role.
+
+  Each role has its own waiter, so that reports of one role (such as many
+  web nodes) cannot stand in for another's. Every waiter fails on the first
+  failure report of any host.
+  """
   statusPath = context.properties["statusPath"]
   waiter_timeout = _Timeout(context)
   return {
-      'name': _WaiterName(context),
+      'name': _WaiterName(context, role),
       'type': 'runtimeconfig.v1beta1.waiter',
       'metadata': {
           'dependsOn': _WaiterDependsOn(context),
       },
       'properties': {
           'parent': '$(ref.{}.name)'.format(_ConfigName(context)),
-          'waiter': 'software',
+          'waiter': 'software-{}'.format(role),
           'timeout': '{}s'.format(waiter_timeout),
           'success': {
               'cardinality': {
-                  'number': _SuccessNumber(context),
-                  'path': '{}/success'.format(statusPath),
+                  'number': number,
+                  'path': '{}/success/{}'.format(statusPath, role),
               },
           },
           'failure': {
@@ -121,9 +137,9 @@ def GenerateConfig(context):
   """Entry function to generate the DM config."""
   statusPath = context.properties["statusPath"]
   content = {
-      'resources': [
-          _RuntimeConfig(context),
-          _Waiter(context),
+      'resources': [_RuntimeConfig(context)] + [
+          _Waiter(context, role, number)
+          for role, number in _RoleCounts(context)
       ],
       'outputs': [
           {
@@ -0,0 +1,109 @@
+#!/bin/bash
+#
+# Builds apache_exporter once from a pinned commit and publishes a versioned,
+# checksummed tarball, so web nodes install a binary instead of compiling.
+#
+# Usage: tools/build_apache_exporter.sh [--pin] REF
+#   REF is the github.com/neezgee/apache_exporter commit or tag to build.
+#   The exporter is cloned at REF. Unless REF vendors its dependencies, each
+#   one is cloned at the revision listed in DEPS, one
+#   "IMPORT_PATH REVISION GIT_URL" per line, and nothing else is fetched.
+#   --pin resolves the dependencies of REF once at their current revisions
+#   and writes DEPS instead of building; review and commit it.
+#
+# Environment: BUCKET (project-edit-usr/5_7_1), GO_IMAGE (golang:1.9),
+#   DEPS (tools/apache_exporter-REF.deps).
+#
+# Prints the apacheExporterUrl and apacheExporterSha256 deployment
+# properties to pin in the deployment config. Every revision the binary was
+# built from is published next to the checksum as NAME.revisions.
+
+set -e
+
+PIN=""
+if [[ "$1" == "--pin" ]]; then
+  PIN="true"
+  shift
+fi
+REF="${1:?usage: $0 [--pin] REF}"
+BUCKET="${BUCKET:-project-edit-usr/5_7_1}"
+GO_IMAGE="${GO_IMAGE:-golang:1.9}"
+DEPS="${DEPS:-$(dirname "$0")/apache_exporter-${REF}.deps}"
+APACHE_EXPORTER_GIT="github.com/neezgee/apache_exporter"
+NAME="apache_exporter-${REF}.linux-amd64"
+TAR="${NAME}.tar.gz"
+WORK_DIR="$(mktemp -d)"
+
+trap 'rm -rf "$WORK_DIR"' EXIT
+
+# Runs in the toolchain image: clone the exporter at REF, then either list
+# its dependencies (pin) or check them out at their pinned revisions (build).
+cat > "$WORK_DIR/build.sh" <<'EOF'
+set -e
+src="$GOPATH/src/$APACHE_EXPORTER_GIT"
+git clone -q "https://$APACHE_EXPORTER_GIT" "$src"
+git -C "$src" checkout -q "$REF"
+
+if [ -n "$PIN" ]; then
+  cd "$src" && go get -d ./...
+  find "$GOPATH/src" -name .git -type d | sort | while read git_dir; do
+    dir="$(dirname "$git_dir")"
+    [ "$dir" != "$src" ] || continue
+    echo "${dir#$GOPATH/src/} $(git -C "$dir" rev-parse HEAD)" \
+      "$(git -C "$dir" config --get remote.origin.url)"
+  done > /out/deps
+  exit 0
+fi
+
+echo "$APACHE_EXPORTER_GIT $(git -C "$src" rev-parse HEAD)" > /out/revisions
+if [ -d "$src/vendor" ]; then
+  echo "dependencies vendored at $REF" >> /out/revisions
+else
+  if [ ! -s /out/deps ]; then
+    echo "$REF vendors no dependencies and DEPS is empty; run with --pin" >&2
+    exit 1
+  fi
+  while read path rev url; do
+    case "$path" in ''|'#'*) continue ;; esac
+    git clone -q "$url" "$GOPATH/src/$path"
+    git -C "$GOPATH/src/$path" checkout -q "$rev"
+    echo "$path $(git -C "$GOPATH/src/$path" rev-parse HEAD)" >> /out/revisions
+  done < /out/deps
+fi
+
+# GOPATH mode never fetches at build time, so a dependency missing from
+# DEPS fails the build instead of being pulled at HEAD.
+cd "$src" && go build -ldflags '-s -w' -o /out/apache_exporter .
+EOF
+
+touch "$WORK_DIR/deps"
+[[ -n "$PIN" || ! -f "$DEPS" ]] || cp "$DEPS" "$WORK_DIR/deps"
+
+# A static, stripped binary built in a pinned toolchain image.
+docker run --rm -v "$WORK_DIR:/out" -e CGO_ENABLED=0 -e PIN="$PIN" \
+  -e REF="$REF" -e APACHE_EXPORTER_GIT="$APACHE_EXPORTER_GIT" "$GO_IMAGE" \
+  sh -c "sh /out/build.sh && chown -R $(id -u):$(id -g) /out"
+
+if [[ -n "$PIN" ]]; then
+  cp "$WORK_DIR/deps" "$DEPS"
+  echo "Pinned $(wc -l < "$DEPS") dependencies of $REF in $DEPS"
+  exit 0
+fi
+
+echo "go image $(docker image inspect --format '{{index .RepoDigests 0}}' \
+  "$GO_IMAGE")" >> "$WORK_DIR/revisions"
+cp "$WORK_DIR/revisions" "$WORK_DIR/$NAME.revisions"
+
+# gzip -n leaves the build time out of the archive, so the checksum only
+# changes with the binary.
+tar -C "$WORK_DIR" --owner=0 --group=0 --mtime='1970-01-01' \
+  -cf - apache_exporter | gzip -n > "$WORK_DIR/$TAR"
+SHA256="$(sha256sum "$WORK_DIR/$TAR" | awk '{print $1}')"
+echo "$SHA256  $TAR" > "$WORK_DIR/$TAR.sha256"
+
+gsutil cp "$WORK_DIR/$TAR" "$WORK_DIR/$TAR.sha256" \
+  "$WORK_DIR/$NAME.revisions" "gs://$BUCKET/"
+
+cat "$WORK_DIR/$NAME.revisions"
+echo "apacheExporterUrl: https://storage.googleapis.com/$BUCKET/$TAR"
+echo "apacheExporterSha256: $SHA256"
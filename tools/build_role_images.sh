@@ -0,0 +1,112 @@
+#!/bin/bash
+#
+# Builds one pre-baked image per role from the role's own startup script.
+#
+# Each role VM boots stock debian-9 with bake-image=true set, so its startup
+# script installs the role's software (install_software), drops the baked
+# marker and stops. The disk then becomes an image in the role's family, for
+# the <role>ImageFamily properties of app.jinja.
+#
+# Usage: tools/build_role_images.sh DEPLOYMENT_DIR [ROLE...]
+#   ROLE is server, workstation, monitor or node; by default every role whose
+#   <role>_startup_script.sh in DEPLOYMENT_DIR supports bake-image is built,
+#   in parallel.
+#
+# Environment: PROJECT (gcloud default), ZONE (us-central1-f),
+#   FAMILY_PREFIX (chef-deployment), BAKE_TIMEOUT (1800 seconds).
+
+set -e
+
+DEPLOYMENT_DIR="${1:?usage: $0 DEPLOYMENT_DIR [ROLE...]}"
+shift
+PROJECT="${PROJECT:-$(gcloud config get-value project 2>/dev/null)}"
+ZONE="${ZONE:-us-central1-f}"
+FAMILY_PREFIX="${FAMILY_PREFIX:-chef-deployment}"
+BAKE_TIMEOUT="${BAKE_TIMEOUT:-1800}"
+BAKE_MACHINE_TYPE="n1-standard-2"
+STAMP="$(date +%Y%m%d%H%M%S)"
+
+function roles() {
+  if [[ $# -gt 0 ]]; then
+    echo "$@"
+    return
+  fi
+  # Only role scripts handle bake-image; the artifact cache has no image.
+  for script in "$DEPLOYMENT_DIR"/*_startup_script.sh; do
+    grep -q "software-status: bake complete" "$script" || continue
+    basename "$script" _startup_script.sh
+  done
+}
+
+function log() {
+  echo "[$1] $2" >&2
+}
+
+function wait_for_bake() {
+  _instance=$1
+  _deadline=$((SECONDS + BAKE_TIMEOUT))
+  while [[ $SECONDS -lt $_deadline ]]; do
+    _output="$(gcloud compute instances get-serial-port-output "$_instance" \
+      --project "$PROJECT" --zone "$ZONE" 2>/dev/null || true)"
+    if grep -q "software-status: bake complete" <<< "$_output"; then
+      return 0
+    fi
+    if grep -q "software-status: bake failed" <<< "$_output"; then
+      return 1
+    fi
+    sleep 15
+  done
+  return 1
+}
+
+function build_image() {
+  _role=$1
+  _script="$DEPLOYMENT_DIR/${_role}_startup_script.sh"
+  _family="${FAMILY_PREFIX}-${_role}"
+  _instance="bake-${_family}-${STAMP}"
+
+  [[ -f $_script ]] || { log "$_role" "no $_script"; return 1; }
+
+  log "$_role" "creating $_instance"
+  gcloud compute instances create "$_instance" \
+    --project "$PROJECT" --zone "$ZONE" \
+    --machine-type "$BAKE_MACHINE_TYPE" \
+    --image-family debian-9 --image-project debian-cloud \
+    --scopes cloud-platform \
+    --metadata bake-image=true \
+    --metadata-from-file startup-script="$_script" > /dev/null
+
+  _result=0
+  if wait_for_bake "$_instance"; then
+    log "$_role" "baked; creating image ${_family}-${STAMP}"
+    gcloud compute instances stop "$_instance" \
+      --project "$PROJECT" --zone "$ZONE" > /dev/null && \
+    gcloud compute images create "${_family}-${STAMP}" \
+      --project "$PROJECT" --family "$_family" \
+      --source-disk "$_instance" --source-disk-zone "$ZONE" > /dev/null \
+      || _result=1
+  else
+    log "$_role" "bake failed:"
+    gcloud compute instances get-serial-port-output "$_instance" \
+      --project "$PROJECT" --zone "$ZONE" 2>/dev/null | tail -n 20 >&2
+    _result=1
+  fi
+
+  gcloud compute instances delete "$_instance" \
+    --project "$PROJECT" --zone "$ZONE" --quiet > /dev/null
+  return $_result
+}
+
+pids=()
+for role in $(roles "$@"); do
+  build_image "$role" &
+  pids+=($!)
+done
+
+status=0
+for pid in "${pids[@]}"; do
+  wait "$pid" || status=1
+done
+
+[[ $status -eq 0 ]] && echo "images built in families ${FAMILY_PREFIX}-<role>"
+exit $status
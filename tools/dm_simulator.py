@@ -0,0 +1,594 @@
+"""Renders a Deployment Manager config offline and simulates its rollout.
+
+The simulator loads a deployment directory (app.jinja plus every template and
+startup script next to it), expands every GenerateConfig(context) template with
+a fake context, and builds the resource graph from $(ref.X.field) references
+and metadata.dependsOn. It then replays the creation of that graph with
+per-resource-type latencies to report the critical path and the expected
+wall-clock deploy time, without talking to GCP.
+
+Usage:
+  python tools/dm_simulator.py monitored-web-cluster
+  python tools/dm_simulator.py chef-automate-infrastructure-management \
+      --latency software.boot=420 --latency chef-server:software=600
+  python tools/dm_simulator.py monitored-web-cluster --manifest
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import re
+import sys
+
+try:
+  import jinja2
+  import yaml
+except ImportError:
+  sys.exit('dm_simulator requires jinja2 and PyYAML: pip install jinja2 pyyaml')
+
+
+REF_PATTERN = re.compile(r'\$\(ref\.([A-Za-z0-9_-]+)\.([^)]*)\)')
+FIELD_PATTERN = re.compile(r'[^.\[]+')
+
+SOFTWARE_SUFFIX = ':software'
+
+# Typical creation latencies in seconds, as observed on our deployments.
+DEFAULT_LATENCIES = {
+    'compute.v1.network': 25,
+    'compute.v1.subnetwork': 15,
+    'compute.v1.firewall': 12,
+    'compute.v1.instance': 35,
+    'compute.v1.instanceTemplate': 6,
+    'compute.v1.instanceGroupManager': 20,
+    'compute.v1.regionInstanceGroupManager': 25,
+    'compute.v1.autoscaler': 12,
+    'compute.v1.regionAutoscaler': 12,
+    'compute.v1.httpHealthCheck': 8,
+    'compute.v1.backendService': 20,
+    'compute.v1.urlMap': 12,
+    'compute.v1.targetHttpProxy': 12,
+    'compute.v1.globalForwardingRule': 25,
+    'runtimeconfig.v1beta1.config': 3,
+    'runtimeconfig.v1beta1.waiter': 3,
+    # Time from VM creation until its startup script posts to status/success.
+    'software.boot': 300,
+}
+
+DEFAULT_PROPERTIES = {
+    'userName': 'chef-user',
+    'userPassword': 'insecurepassword',
+    'zone': 'us-central1-f',
+    'sshPubKey': 'ssh-rsa AAAA chef-user',
+    'keyFile': 'chef-user.pem',
+}
+
+# Fields the API returns for a resource besides its properties; a reference
+# must name one of these or a top-level property.
+COMMON_OUTPUT_FIELDS = ('id', 'kind', 'name', 'selfLink', 'creationTimestamp')
+OUTPUT_FIELDS = {
+    'compute.v1.instance': ('status', 'cpuPlatform'),
+    'compute.v1.instanceGroupManager': (
+        'instanceGroup', 'currentActions', 'fingerprint', 'status'),
+    'compute.v1.regionInstanceGroupManager': (
+        'instanceGroup', 'currentActions', 'fingerprint', 'status'),
+    'compute.v1.globalForwardingRule': ('IPAddress',),
+    'runtimeconfig.v1beta1.waiter': ('done', 'error'),
+}
+
+GROUP_MANAGER_TYPES = (
+    'compute.v1.instanceGroupManager',
+    'compute.v1.regionInstanceGroupManager',
+)
+
+
+class SimulatorError(Exception):
+  """An exception raised when a config cannot be rendered or simulated."""
+  pass
+
+
+class FakeContext(object):
+  """Stands in for the context object Deployment Manager passes to templates."""
+
+  def __init__(self, env, properties, imports):
+    self.env = env
+    self.properties = properties
+    self.imports = imports
+
+
+def _LoadImports(path):
+  """Returns every file of a deployment directory keyed by its file name."""
+  imports = {}
+  for file_name in sorted(os.listdir(path)):
+    file_path = os.path.join(path, file_name)
+    if os.path.isfile(file_path):
+      with open(file_path) as f:
+        imports[file_name] = f.read()
+  return imports
+
+
+def _RenderJinja(source, context):
+  """Renders a jinja template the way Deployment Manager does."""
+  template = jinja2.Template(source)
+  rendered = template.render(
+      env=context.env, properties=context.properties, imports=context.imports)
+  return yaml.safe_load(rendered) or {}
+
+
+def _RenderPython(path, file_name, context):
+  """Runs GenerateConfig(context) from a python template."""
+  module_name = '_dm_' + re.sub(r'\W', '_', file_name[:-len('.py')])
+  spec = importlib.util.spec_from_file_location(
+      module_name, os.path.join(path, file_name))
+  module = importlib.util.module_from_spec(spec)
+  # Templates import helper modules of their deployment by plain name, as
+  # Deployment Manager allows for every imported .py file; drop copies
+  # loaded from another deployment directory first.
+  for name in context.imports:
+    if name.endswith('.py'):
+      sys.modules.pop(name[:-len('.py')], None)
+  sys.path.insert(0, path)
+  try:
+    spec.loader.exec_module(module)
+  finally:
+    sys.path.remove(path)
+  try:
+    return module.GenerateConfig(context) or {}
+  except Exception as e:
+    raise SimulatorError('{} ({}): {}: {}'.format(
+        file_name, context.env['name'], type(e).__name__, e))
+
+
+class Deployment(object):
+  """A fully expanded deployment: base resources, templates and their edges."""
+
+  def __init__(self, path, deployment, project, properties, config='app.jinja'):
+    self.path = path
+    self.imports = _LoadImports(path)
+    self.env = {
+        'deployment': deployment,
+        'project': project,
+        'project_number': '123456789012',
+        'username': 'dm-simulator',
+        'current_time': 0,
+    }
+    # Base resources keyed by name, in manifest order.
+    self.resources = []
+    self.by_name = {}
+    # Template resources: name -> {'type', 'leaves', 'outputs'}.
+    self.templates = {}
+    self.outputs = []
+    if config not in self.imports:
+      raise SimulatorError('No {} in {}'.format(config, path))
+    root = self._Render(config, dict(self.env, name=deployment,
+                                     type=config), properties)
+    self.outputs = root.get('outputs', [])
+    for resource in root.get('resources', []):
+      self._Expand(resource, [])
+    for output in self.outputs:
+      for name, field in _FindRefs(output.get('value')):
+        self.Resolve(name, field)
+
+  def _Render(self, file_name, env, properties):
+    """Renders one template with a fake context."""
+    context = FakeContext(env, properties, self.imports)
+    if file_name.endswith('.py'):
+      return _RenderPython(self.path, file_name, context)
+    if file_name.endswith('.jinja'):
+      return _RenderJinja(self.imports[file_name], context)
+    raise SimulatorError('Unsupported template type: {}'.format(file_name))
+
+  def _Expand(self, resource, inherited_deps):
+    """Expands a resource into base resources, returning their names."""
+    name = resource['name']
+    type_name = resource['type']
+    depends_on = list(inherited_deps)
+    depends_on += resource.get('metadata', {}).get('dependsOn', [])
+
+    if type_name not in self.imports:
+      if name in self.by_name:
+        raise SimulatorError('Duplicate resource name: {}'.format(name))
+      resource = dict(resource)
+      resource['metadata'] = dict(resource.get('metadata', {}),
+                                  dependsOn=depends_on)
+      self.resources.append(resource)
+      self.by_name[name] = resource
+      return [name]
+
+    env = dict(self.env, name=name, type=type_name)
+    config = self._Render(type_name, env, resource.get('properties', {}))
+    leaves = []
+    for child in config.get('resources', []):
+      leaves += self._Expand(child, depends_on)
+    self.templates[name] = {
+        'type': type_name,
+        'leaves': leaves,
+        'outputs': dict((o['name'], o['value'])
+                        for o in config.get('outputs', [])),
+    }
+    return leaves
+
+  def Resolve(self, name, field=None, seen=None):
+    """Returns the base resources a reference to name(.field) waits for.
+
+    A field must be an output of the template or a field of the resource
+    called name. A template output is ambiguous when a resource shares the
+    template's name, as Deployment Manager may resolve it to either.
+    """
+    resource = self.by_name.get(name)
+    template = self.templates.get(name)
+    if resource is None and template is None:
+      raise SimulatorError('Reference to unknown resource: {}'.format(name))
+    output_name = _FieldHead(field)
+    if template is not None and output_name in template['outputs']:
+      if resource is not None:
+        raise SimulatorError(
+            'Ambiguous reference {}.{}: {} names both a {} template and a {} '
+            'resource'.format(name, field, name, template['type'],
+                              resource['type']))
+      seen = seen or set()
+      if (name, output_name) in seen:
+        raise SimulatorError('Cyclic template output: {}.{}'.format(
+            name, output_name))
+      seen.add((name, output_name))
+      names = set()
+      for ref, ref_field in _FindRefs(template['outputs'][output_name]):
+        names |= self.Resolve(ref, ref_field, seen)
+      return names
+    if resource is not None:
+      if output_name is not None and output_name not in _Fields(resource):
+        raise SimulatorError('Reference to unknown field {}.{} of {}'.format(
+            name, field, resource['type']))
+      return set([name])
+    if output_name is not None:
+      raise SimulatorError('Reference to unknown output {}.{} of {}'.format(
+          name, field, template['type']))
+    return set(template['leaves'])
+
+  def Edges(self, resource):
+    """Returns {dependency: kind} for a base resource.
+
+    kind is 'ref' when a $(ref.X.field) reference implies the edge and
+    'dependsOn' when only metadata.dependsOn does.
+    """
+    edges = {}
+    for name in resource.get('metadata', {}).get('dependsOn', []):
+      for dep in self.Resolve(name):
+        edges[dep] = 'dependsOn'
+    for name, field in _FindRefs(resource.get('properties', {})):
+      for dep in self.Resolve(name, field):
+        edges[dep] = 'ref'
+    edges.pop(resource['name'], None)
+    return edges
+
+  def Manifest(self):
+    """Returns the expanded manifest as Deployment Manager would store it."""
+    return {'resources': self.resources, 'outputs': self.outputs}
+
+
+def _FindRefs(value):
+  """Yields (name, field) for every $(ref.name.field) inside value."""
+  if isinstance(value, dict):
+    for item in value.values():
+      for ref in _FindRefs(item):
+        yield ref
+  elif isinstance(value, list):
+    for item in value:
+      for ref in _FindRefs(item):
+        yield ref
+  elif isinstance(value, str):
+    for match in REF_PATTERN.finditer(value):
+      yield match.group(1), match.group(2)
+
+
+def _FieldHead(field):
+  """Returns the top-level name of a reference field, or None without one."""
+  match = FIELD_PATTERN.match(field or '')
+  return match.group(0) if match else None
+
+
+def _Fields(resource):
+  """Returns the fields a reference to a base resource may name."""
+  return (set(resource.get('properties', {})) |
+          set(COMMON_OUTPUT_FIELDS) |
+          set(OUTPUT_FIELDS.get(resource['type'], ())))
+
+
+def _MetadataValue(resource, key):
+  """Returns a metadata item of an instance or instance template."""
+  properties = resource.get('properties', {})
+  if resource['type'] == 'compute.v1.instanceTemplate':
+    properties = properties.get('properties', {})
+  for item in properties.get('metadata', {}).get('items', []):
+    if item.get('key') == key:
+      return item.get('value')
+  return None
+
+
+def _UnderPath(path, root):
+  """Returns whether a RuntimeConfig variable path lies in root's subtree."""
+  return path == root or path.startswith(root + '/')
+
+
+class Simulation(object):
+  """Replays the creation of a Deployment with per-type latencies."""
+
+  def __init__(self, deployment, latencies=None):
+    self.deployment = deployment
+    self.latencies = dict(DEFAULT_LATENCIES)
+    self.latencies.update(latencies or {})
+    self.nodes = {}
+    self.order = []
+    self._Build()
+    self._Run()
+
+  def Latency(self, name, type_name):
+    """Returns the latency for a resource, by name first and then by type."""
+    if name in self.latencies:
+      return self.latencies[name]
+    if type_name in self.latencies:
+      return self.latencies[type_name]
+    return self.latencies.get('default', 10)
+
+  def _AddNode(self, name, type_name, deps, **extra):
+    node = {
+        'name': name,
+        'type': type_name,
+        'deps': deps,
+        'latency': self.Latency(name, type_name),
+    }
+    node.update(extra)
+    self.nodes[name] = node
+    return node
+
+  def _Build(self):
+    """Creates one node per base resource plus one per software writer."""
+    deployment = self.deployment
+    templates = {}
+    for resource in deployment.resources:
+      self._AddNode(resource['name'], resource['type'],
+                    deployment.Edges(resource))
+      if resource['type'] == 'compute.v1.instanceTemplate':
+        templates[resource['name']] = resource
+
+    # Every VM whose startup script posts to RuntimeConfig is a writer whose
+    # report gates the waiters on its status path.
+    self.writers = []
+    for resource in deployment.resources:
+      name = resource['name']
+      if resource['type'] == 'compute.v1.instance':
+        source, count = resource, 1
+      elif resource['type'] in GROUP_MANAGER_TYPES:
+        refs = deployment.Edges(resource)
+        source = next((templates[r] for r in refs if r in templates), None)
+        count = int(resource['properties'].get('targetSize', 0))
+      else:
+        continue
+      if source is None:
+        continue
+      path = _MetadataValue(source, 'status-variable-path')
+      if path is None:
+        continue
+      successPath = '{}/success'.format(path)
+      role = _MetadataValue(source, 'status-role')
+      if role:
+        successPath = '{}/{}'.format(successPath, role)
+      writer = self._AddNode(name + SOFTWARE_SUFFIX, 'software.boot',
+                             {name: 'boot'}, count=count,
+                             successPath=successPath)
+      self.writers.append(writer)
+
+  def _Order(self):
+    """Returns node names in an order where dependencies come first."""
+    order = []
+    state = {}
+
+    def Visit(name, stack):
+      if state.get(name) == 'done':
+        return
+      if state.get(name) == 'visiting':
+        raise SimulatorError('Dependency cycle: {}'.format(
+            ' -> '.join(stack + [name])))
+      state[name] = 'visiting'
+      node = self.nodes[name]
+      for dep in sorted(node['deps']):
+        Visit(dep, stack + [name])
+      for writer in node.get('writers', []):
+        Visit(writer['name'], stack + [name])
+      state[name] = 'done'
+      order.append(name)
+
+    for name in sorted(self.nodes):
+      Visit(name, [])
+    return order
+
+  def _Run(self):
+    """Computes the start and finish time of every node."""
+    for node in self.nodes.values():
+      if node['type'] != 'runtimeconfig.v1beta1.waiter':
+        continue
+      resource = self.deployment.by_name[node['name']]
+      success = resource['properties']['success']['cardinality']
+      node['number'] = int(success['number'])
+      node['path'] = success['path']
+      node['timeout'] = int(
+          str(resource['properties'].get('timeout', '0')).rstrip('s'))
+      node['writers'] = [w for w in self.writers
+                         if _UnderPath(w['successPath'], node['path'])]
+
+    self.order = self._Order()
+    for name in self.order:
+      node = self.nodes[name]
+      start, critical = 0, None
+      for dep in node['deps']:
+        if self.nodes[dep]['finish'] > start:
+          start, critical = self.nodes[dep]['finish'], dep
+      node['start'] = start
+      node['finish'] = start + node['latency']
+      node['critical'] = critical
+      if 'writers' in node:
+        self._FinishWaiter(node)
+
+  def _FinishWaiter(self, node):
+    """A waiter finishes once `number` hosts have reported on its path."""
+    reports = []
+    for writer in node['writers']:
+      reports += [(writer['finish'], writer['name'])] * writer['count']
+    reports.sort()
+    node['reports'] = len(reports)
+    if len(reports) < node['number']:
+      node['timedOut'] = True
+      node['finish'] = node['start'] + node['timeout']
+      return
+    ready, writer = reports[node['number'] - 1]
+    if ready > node['finish']:
+      node['finish'] = ready
+      node['critical'] = writer
+
+  def Total(self):
+    """Returns the expected wall-clock deploy time in seconds."""
+    return max([n['finish'] for n in self.nodes.values()] or [0])
+
+  def CriticalPath(self):
+    """Returns the nodes on the longest path, in creation order."""
+    if not self.nodes:
+      return []
+    name = max(reversed(self.order), key=lambda n: self.nodes[n]['finish'])
+    path = []
+    while name is not None:
+      path.append(self.nodes[name])
+      name = self.nodes[name]['critical']
+    return list(reversed(path))
+
+  def Serialization(self):
+    """Returns the dependsOn edges that delay a resource past its refs.
+
+    An edge only declared in metadata.dependsOn is not needed to resolve any
+    $(ref...) value; whenever such a dependency finishes after everything the
+    resource actually references, the rollout is serialized for no reason.
+    """
+    points = []
+    for name in self.order:
+      node = self.nodes[name]
+      needed = [self.nodes[d]['finish'] for d, kind in node['deps'].items()
+                if kind != 'dependsOn']
+      ready = max(needed or [0])
+      for dep, kind in sorted(node['deps'].items()):
+        delay = self.nodes[dep]['finish'] - ready
+        if kind == 'dependsOn' and delay > 0:
+          points.append({'name': name, 'dependsOn': dep, 'delay': delay})
+    return points
+
+  def Report(self):
+    """Returns a JSON-serializable summary of the simulation."""
+    return {
+        'deployment': self.deployment.env['deployment'],
+        'resources': len(self.deployment.resources),
+        'totalSeconds': self.Total(),
+        'criticalPath': [n['name'] for n in self.CriticalPath()],
+        'serialization': self.Serialization(),
+        'nodes': [{
+            'name': n['name'],
+            'type': n['type'],
+            'start': n['start'],
+            'finish': n['finish'],
+            'dependsOn': sorted(n['deps']),
+        } for n in (self.nodes[name] for name in self.order)],
+        'waiters': [{
+            'name': n['name'],
+            'path': n['path'],
+            'number': n['number'],
+            'reports': n['reports'],
+            'finish': n['finish'],
+            'timedOut': n.get('timedOut', False),
+        } for n in self._Waiters()],
+    }
+
+  def _Waiters(self):
+    return [self.nodes[name] for name in self.order
+            if 'writers' in self.nodes[name]]
+
+
+def _FormatReport(simulation):
+  """Returns a human readable report of a simulation."""
+  lines = [
+      'Deployment {}: {} resources, {} software writers'.format(
+          simulation.deployment.env['deployment'],
+          len(simulation.deployment.resources), len(simulation.writers)),
+      'Expected wall-clock deploy time: {}s'.format(simulation.Total()),
+      '',
+      'Critical path:',
+  ]
+  for node in simulation.CriticalPath():
+    via = node['deps'].get(node['critical'])
+    via = via or ('report' if node['critical'] else '-')
+    lines.append('  {:>5}s - {:>5}s  {} ({}, via {})'.format(
+        node['start'], node['finish'], node['name'], node['type'], via))
+  lines += ['', 'Serialized by dependsOn-only edges:']
+  points = simulation.Serialization()
+  for point in points:
+    lines.append('  {name} waits {delay}s for {dependsOn}'.format(**point))
+  if not points:
+    lines.append('  none')
+  lines += ['', 'Waiters:']
+  for node in simulation._Waiters():
+    status = 'TIMEOUT' if node.get('timedOut') else 'ready'
+    lines.append('  {} waits for {} of {} reports on {}: {} at {}s'
+                 .format(node['name'], node['number'], node['reports'],
+                         node['path'], status, node['finish']))
+  return '\n'.join(lines)
+
+
+def _ParseAssignments(values, convert):
+  """Parses KEY=VALUE command line arguments."""
+  result = {}
+  for value in values or []:
+    key, sep, raw = value.partition('=')
+    if not sep:
+      raise SimulatorError('Expected KEY=VALUE, got: {}'.format(value))
+    result[key] = convert(raw)
+  return result
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('path', help='deployment directory, e.g. '
+                      'monitored-web-cluster')
+  parser.add_argument('--config', default='app.jinja',
+                      help='top-level template inside path')
+  parser.add_argument('--deployment', default='chef-deployment')
+  parser.add_argument('--project', default='chef-project')
+  parser.add_argument('--property', action='append', metavar='KEY=VALUE',
+                      help='top-level property (YAML value)')
+  parser.add_argument('--latency', action='append', metavar='KEY=SECONDS',
+                      help='latency override for a resource name, resource '
+                      'type, software.boot or <name>:software')
+  parser.add_argument('--manifest', action='store_true',
+                      help='print the expanded manifest instead')
+  parser.add_argument('--json', action='store_true',
+                      help='print the simulation report as JSON')
+  args = parser.parse_args(argv)
+
+  try:
+    properties = dict(DEFAULT_PROPERTIES)
+    properties.update(_ParseAssignments(args.property, yaml.safe_load))
+    latencies = _ParseAssignments(args.latency, float)
+    deployment = Deployment(args.path, args.deployment, args.project,
+                            properties, args.config)
+    if args.manifest:
+      print(yaml.safe_dump(deployment.Manifest(), default_flow_style=False))
+      return 0
+    simulation = Simulation(deployment, latencies)
+  except SimulatorError as e:
+    print('error: {}'.format(e), file=sys.stderr)
+    return 1
+
+  if args.json:
+    print(json.dumps(simulation.Report(), indent=2, sort_keys=True))
+  else:
+    print(_FormatReport(simulation))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())